@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Downloads files from a local HTTP server over concurrent streams sharing
+# one `--max-rate` limiter, and reports the total rate against the limit,
+# the rate of each stream and how evenly they shared it (Jain's index, 1.0
+# is a perfectly even share). In a second round every other stream starts
+# late, so the total only stays at the limit if the rate is handed over as
+# streams come and go. The CPU cost per GB is compared against unlimited
+# downloads.
+#
+#     python benchmarks/bandwidth.py --rate 20M --streams 4 --size 32
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from download_throughput import serve
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from hublatest.bandwidth import (  # noqa: E402
+    BandwidthLimiter, parse_rate, parse_schedule)
+from hublatest.file_download import file_download  # noqa: E402
+from hublatest.session import Session  # noqa: E402
+
+
+def run_streams(url, directory, streams, delay, bandwidth):
+    session = Session(pool_size=streams)
+    results = [None] * streams
+
+    def run(i):
+        time.sleep(delay if i % 2 else 0)
+        started = time.perf_counter()
+        file_path = os.path.join(directory, "asset{}.bin".format(i))
+        file_download(url, file_path, session=session, bandwidth=bandwidth)
+        size = os.path.getsize(file_path)
+        os.remove(file_path)
+        results[i] = (started, time.perf_counter(), size)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(streams)]
+    cpu_start = time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.process_time() - cpu_start
+
+
+def jain_index(rates):
+    return sum(rates) ** 2 / (len(rates) * sum(rate ** 2 for rate in rates))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the shared bandwidth limiter")
+    parser.add_argument("--rate", default="20M",
+                        help="Shared rate, like `--max-rate` but without a "
+                             "schedule (default: 20M)")
+    parser.add_argument("--streams", metavar="N", type=int, default=4,
+                        help="Concurrent downloads (default: 4)")
+    parser.add_argument("--size", metavar="MIB", type=int, default=32,
+                        help="Size of each file (default: 32)")
+    parser.add_argument("--delay", metavar="SECONDS", type=float, default=1.0,
+                        help="Start delay of every second stream "
+                             "(default: 1)")
+    parser.add_argument("--port", metavar="PORT", type=int, default=8767,
+                        help="Port of the local server (default: 8767)")
+    args = parser.parse_args()
+    rate = parse_rate(args.rate)
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args.size * 1024 * 1024, ready),
+        daemon=True)
+    server.start()
+    ready.wait()
+
+    url = "http://127.0.0.1:{}/asset.bin".format(args.port)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            unlimited, unlimited_cpu = run_streams(
+                url, directory, args.streams, 0, None)
+            rounds = [
+                (name,) + run_streams(
+                    url, directory, args.streams, delay,
+                    BandwidthLimiter(parse_schedule(args.rate)))
+                for name, delay in (("even", 0), ("staggered", args.delay))]
+    finally:
+        server.terminate()
+
+    print("limit {:.2f} MiB/s, unlimited CPU {:.2f} s/GB".format(
+        rate / 1024 ** 2, get_cpu_per_gb(unlimited, unlimited_cpu)))
+    print("{:<10} {:>12} {:>10} {:>10}  {}".format(
+        "round", "total MiB/s", "fairness", "CPU s/GB", "MiB/s per stream"))
+    for name, results, cpu in rounds:
+        begin = min(started for started, _end, _size in results)
+        end = max(ended for _start, ended, _size in results)
+        total = sum(size for _start, _end, size in results)
+        rates = [size / (ended - started)
+                 for started, ended, size in results]
+        print("{:<10} {:>12.2f} {:>10.3f} {:>10.2f}  {}".format(
+            name, total / (end - begin) / 1024 ** 2, jain_index(rates),
+            get_cpu_per_gb(results, cpu),
+            " ".join("{:.2f}".format(rate / 1024 ** 2) for rate in rates)))
+
+
+def get_cpu_per_gb(results, cpu):
+    return cpu / sum(size for _start, _end, size in results) * 1e9
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Compares the throughput and CPU cost of the download write path against
+# the previous 1 KiB `iter_content` loop, using a local HTTP server.
+#
+#     python benchmarks/download_throughput.py --size 1024 --repeat 3
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from hublatest.file_download import file_download  # noqa: E402
+from hublatest.session import Session  # noqa: E402
+
+
+def serve(port, size, ready):
+    block = os.urandom(1024 * 1024)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            start, end = 0, size - 1
+            range_header = self.headers.get("Range")
+            if range_header:
+                first, last = range_header[len("bytes="):].split("-")
+                start = int(first)
+                end = int(last) if last else size - 1
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", "bytes {}-{}/{}".format(start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end + 1 - start))
+            self.end_headers()
+            view = memoryview(block)
+            offset = start
+            while offset <= end:
+                position = offset % len(block)
+                length = min(len(block) - position, end + 1 - offset)
+                self.wfile.write(view[position:position + length])
+                offset += length
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    ready.set()
+    server.serve_forever()
+
+
+def legacy_download(url, file_path, session):
+    # The write loop used before the large-chunk path
+    sha256 = hashlib.sha256()
+    response = session.get(url, stream=True)
+    with open(file_path, "wb") as f:
+        for chunk in response.iter_content(1024):
+            if chunk:
+                f.write(chunk)
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def current_download(url, file_path, session):
+    return file_download(url, file_path, session=session)
+
+
+def measure(function, url, directory, session):
+    file_path = os.path.join(directory, "asset.bin")
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    function(url, file_path, session)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    return wall, cpu, os.path.getsize(file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the download write path")
+    parser.add_argument("--size", metavar="MIB", type=int, default=512,
+                        help="Size of the downloaded file (default: 512)")
+    parser.add_argument("--repeat", metavar="N", type=int, default=3,
+                        help="Runs per write path (default: 3)")
+    parser.add_argument("--port", metavar="PORT", type=int, default=8766,
+                        help="Port of the local server (default: 8766)")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args.size * 1024 * 1024, ready),
+        daemon=True)
+    server.start()
+    ready.wait()
+
+    url = "http://127.0.0.1:{}/asset.bin".format(args.port)
+    session = Session()
+    print("{:<10} {:>10} {:>10} {:>12}".format(
+        "path", "MB/s", "wall s", "CPU s/GB"))
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, function in (("legacy", legacy_download),
+                                   ("current", current_download)):
+                for _ in range(args.repeat):
+                    wall, cpu, size = measure(
+                        function, url, directory, session)
+                    print("{:<10} {:>10.1f} {:>10.2f} {:>12.2f}".format(
+                        name, size / wall / 1e6, wall, cpu / size * 1e9))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
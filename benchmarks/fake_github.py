@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+# A local stand-in for GitHub: serves the releases API, the GraphQL release
+# lookup and release assets (with single and multiple Range support) for any
+# `owner/repo`, with configurable latency and bandwidth. With `--zsync`, the
+# releases of different tags share most of their content and each asset
+# comes with a `.zsync` file, for delta updates. With `--rate-limit`, the
+# REST and GraphQL APIs each get a quota reported in `X-RateLimit-*` headers
+# like GitHub's, answered with 403 once used up, and `--secondary-limit`
+# answers every Nth API request with 429 and `Retry-After`. Counters are
+# served at `/_stats`.
+#
+#     python benchmarks/fake_github.py --port 8770 --latency 0.05
+#     python benchmarks/fake_github.py --zsync --asset-size 4194304 --tag v2
+#     python benchmarks/fake_github.py --rate-limit 100 --rate-window 60
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+RELEASE_PATTERN = re.compile(
+    r"^/repos/([^/]+)/([^/]+)/releases(/latest)?(?:\?(.*))?$")
+ASSET_PATTERN = re.compile(r"^/dl/([^/]+)/([^/]+)/([^/]+)/(\d+)(\.zsync)?$")
+WRITE_SIZE = 64 * 1024
+MULTIPART_BOUNDARY = "fake-github-byteranges"
+
+# Each tag changes this many places of this size in the shared content
+CHANGES_PER_RELEASE = 4
+CHANGE_SIZE = 1000
+ZSYNC_BLOCK_SIZE = 2048
+ZSYNC_SUFFIX = ".zsync"
+
+
+class FakeGitHub(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, assets=3, asset_size=64 * 1024, tag="v1",
+                 latency=0.0, bandwidth=0, zsync=False, rate_limit=0,
+                 rate_window=3600.0, secondary_limit=0, retry_after=1):
+        super().__init__(address, Handler)
+        self.assets = assets
+        self.asset_size = asset_size
+        self.tag = tag
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.zsync = zsync
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.secondary_limit = secondary_limit
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.cache = {}
+        # The reset time and the used requests of each API's quota
+        self.quotas = {}
+        self.limited_requests = 0
+        self.stats = {
+            "api_requests": 0,
+            "not_modified": 0,
+            "graphql_requests": 0,
+            "asset_requests": 0,
+            "rate_limited": 0,
+            "bytes_sent": 0
+        }
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def base_url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def take_quota(self, resource):
+        # Returns the status to answer an API request with (None to serve
+        # it) and the rate limit headers
+        if not self.rate_limit and not self.secondary_limit:
+            return None, []
+        with self.lock:
+            self.limited_requests += 1
+            if self.secondary_limit and \
+                    self.limited_requests % self.secondary_limit == 0:
+                self.stats["rate_limited"] += 1
+                return 429, [("Retry-After", str(self.retry_after))]
+            if not self.rate_limit:
+                return None, []
+            now = time.time()
+            reset, used = self.quotas.get(resource, (0, 0))
+            if reset <= now:
+                reset, used = int(now + self.rate_window), 0
+            status = None
+            if used < self.rate_limit:
+                used += 1
+            else:
+                status = 403
+                self.stats["rate_limited"] += 1
+            self.quotas[resource] = reset, used
+        return status, [
+            ("X-RateLimit-Limit", str(self.rate_limit)),
+            ("X-RateLimit-Remaining", str(self.rate_limit - used)),
+            ("X-RateLimit-Reset", str(reset)),
+            ("X-RateLimit-Used", str(used)),
+            ("X-RateLimit-Resource", resource)]
+
+    def asset_data(self, path):
+        # Deterministic content, so the digest of an asset never changes
+        if self.zsync:
+            return self.cached(path, self.make_release_data, path)
+        seed = hashlib.sha256(path.encode()).digest()
+        return (seed * (self.asset_size // len(seed) + 1))[:self.asset_size]
+
+    def cached(self, key, function, *args):
+        with self.lock:
+            value = self.cache.get(key)
+        if value is None:
+            value = function(*args)
+            with self.lock:
+                self.cache[key] = value
+        return value
+
+    def make_release_data(self, path):
+        # Random content shared by all tags, with a few places changed by
+        # each tag
+        owner, repo, _tag, i, _zsync = ASSET_PATTERN.match(path).groups()
+        size = self.asset_size
+        data = bytearray(random.Random("/".join((owner, repo, i)))
+                         .getrandbits(8 * size).to_bytes(size, "little"))
+        changes = random.Random(path)
+        for _ in range(CHANGES_PER_RELEASE):
+            position = changes.randrange(size)
+            data[position:position + CHANGE_SIZE] = changes.getrandbits(
+                8 * CHANGE_SIZE).to_bytes(CHANGE_SIZE, "little")
+        return bytes(data[:size])
+
+    def zsync_data(self, path):
+        return self.cached(path + ZSYNC_SUFFIX, self.make_zsync, path)
+
+    def make_zsync(self, path):
+        from hublatest.delta import get_rsum, md4
+        data = self.asset_data(path)
+        header = [
+            "zsync: 0.6.2",
+            "Filename: " + path.rsplit("/", 1)[-1],
+            "Blocksize: {}".format(ZSYNC_BLOCK_SIZE),
+            "Length: {}".format(len(data)),
+            "Hash-Lengths: 2,2,5",
+            "SHA-1: " + hashlib.sha1(data).hexdigest()]
+        checksums = bytearray()
+        for offset in range(0, len(data), ZSYNC_BLOCK_SIZE):
+            block = data[offset:offset + ZSYNC_BLOCK_SIZE].ljust(
+                ZSYNC_BLOCK_SIZE, b"\0")
+            a, b = get_rsum(block)
+            checksums += ((a << 16) | b).to_bytes(4, "big")[2:]
+            checksums += md4(block)[:5]
+        return ("\n".join(header) + "\n\n").encode() + bytes(checksums)
+
+    def asset_digest(self, path):
+        with self.lock:
+            digest = self.digests.get(path)
+        if digest is None:
+            digest = hashlib.sha256(self.asset_data(path)).hexdigest()
+            with self.lock:
+                self.digests[path] = digest
+        return digest
+
+    def get_releases(self, owner, repo):
+        # The newest release is a prerelease, followed by a stable one
+        releases = []
+        for tag, prerelease in ((self.tag + "-rc", True), (self.tag, False)):
+            assets = []
+            for i in range(self.assets):
+                path = "/dl/{}/{}/{}/{}".format(owner, repo, tag, i)
+                assets.append({
+                    "name": "{}-{}-{}.bin".format(repo, tag, i),
+                    "size": self.asset_size,
+                    "updated_at": "2020-01-01T00:00:00Z",
+                    "digest": "sha256:" + self.asset_digest(path),
+                    "browser_download_url": self.base_url() + path
+                })
+                if self.zsync:
+                    assets.append({
+                        "name": assets[-1]["name"] + ZSYNC_SUFFIX,
+                        "size": len(self.zsync_data(path)),
+                        "updated_at": "2020-01-01T00:00:00Z",
+                        "browser_download_url":
+                            self.base_url() + path + ZSYNC_SUFFIX
+                    })
+            releases.append({
+                "tag_name": tag,
+                "prerelease": prerelease,
+                "draft": False,
+                "assets": assets
+            })
+        return releases
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        match = RELEASE_PATTERN.match(self.path)
+        if match:
+            self.send_releases(*match.groups())
+        elif ASSET_PATTERN.match(self.path):
+            self.send_asset()
+        elif self.path == "/_stats":
+            with self.server.lock:
+                stats = dict(self.server.stats)
+            self.send_json(stats)
+        else:
+            self.send_body(404, b"")
+
+    def do_POST(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.path != "/graphql":
+            self.send_body(404, b"")
+            return
+        self.server.count("graphql_requests")
+        request = json.loads(
+            self.rfile.read(int(self.headers["Content-Length"])))
+        status, headers = self.server.take_quota("graphql")
+        if status is not None:
+            self.send_rate_limited(status, headers)
+            return
+        query, variables = request["query"], request["variables"]
+        data = {}
+        i = 0
+        while "o{}".format(i) in variables:
+            owner = variables["o{}".format(i)]
+            repo = variables["n{}".format(i)]
+            nodes = [
+                {
+                    "tagName": release["tag_name"],
+                    "isPrerelease": release["prerelease"],
+                    "isDraft": release["draft"],
+                    "releaseAssets": {
+                        "pageInfo": {"hasNextPage": False},
+                        "nodes": [
+                            {
+                                "name": asset["name"],
+                                "size": asset["size"],
+                                "updatedAt": asset["updated_at"],
+                                "downloadUrl": asset["browser_download_url"]
+                            }
+                            for asset in release["assets"]]
+                    }
+                }
+                for release in self.server.get_releases(owner, repo)]
+            field = "r{0}: repository(owner: $o{0}, name: $n{0}) {{ " \
+                "latestRelease".format(i)
+            if field in query:
+                data["r{}".format(i)] = {"latestRelease": nodes[1]}
+            else:
+                data["r{}".format(i)] = {"releases": {"nodes": nodes}}
+            i += 1
+        self.send_json({"data": data}, headers)
+
+    def send_releases(self, owner, repo, latest, query):
+        self.server.count("api_requests")
+        status, headers = self.server.take_quota("core")
+        if status is not None:
+            self.send_rate_limited(status, headers)
+            return
+        releases = self.server.get_releases(owner, repo)
+        if latest:
+            body = releases[1]
+        else:
+            params = dict(
+                param.split("=", 1) for param in (query or "").split("&")
+                if "=" in param)
+            per_page = int(params.get("per_page", 30))
+            page = int(params.get("page", 1))
+            body = releases[(page - 1) * per_page:page * per_page]
+        data = json.dumps(body).encode()
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            for header in headers:
+                self.send_header(*header)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_body(200, data, [("ETag", etag),
+                                   ("Content-Type", "application/json")]
+                       + headers)
+
+    def send_rate_limited(self, status, headers):
+        self.send_body(status, json.dumps({
+            "message": "API rate limit exceeded" if status == 403
+            else "You have exceeded a secondary rate limit"}).encode(),
+            [("Content-Type", "application/json")] + headers)
+
+    def send_asset(self):
+        self.server.count("asset_requests")
+        if self.path.endswith(ZSYNC_SUFFIX):
+            data = self.server.zsync_data(self.path[:-len(ZSYNC_SUFFIX)])
+        else:
+            data = self.server.asset_data(self.path)
+        range_header = self.headers.get("Range")
+        if not range_header:
+            self.send_body(200, data)
+            return
+        ranges = []
+        for byte_range in range_header[len("bytes="):].split(","):
+            first, last = byte_range.strip().split("-")
+            end = min(int(last), len(data) - 1) if last else len(data) - 1
+            ranges.append((int(first), end))
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_body(206, data[start:end + 1], [
+                ("Content-Range",
+                 "bytes {}-{}/{}".format(start, end, len(data)))])
+            return
+        body = bytearray()
+        for start, end in ranges:
+            body += (
+                "--{}\r\nContent-Type: application/octet-stream\r\n"
+                "Content-Range: bytes {}-{}/{}\r\n\r\n".format(
+                    MULTIPART_BOUNDARY, start, end, len(data))).encode()
+            body += data[start:end + 1] + b"\r\n"
+        body += "--{}--\r\n".format(MULTIPART_BOUNDARY).encode()
+        self.send_body(206, bytes(body), [
+            ("Content-Type",
+             "multipart/byteranges; boundary=" + MULTIPART_BOUNDARY)])
+
+    def send_json(self, value, headers=()):
+        self.send_body(200, json.dumps(value).encode(),
+                       [("Content-Type", "application/json")] + list(headers))
+
+    def send_body(self, status, data, headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        view = memoryview(data)
+        started = time.monotonic()
+        for offset in range(0, len(data), WRITE_SIZE):
+            chunk = view[offset:offset + WRITE_SIZE]
+            self.wfile.write(chunk)
+            self.server.count("bytes_sent", len(chunk))
+            # Each connection is limited to the configured bandwidth
+            if self.server.bandwidth:
+                ahead = (offset + len(chunk)) / self.server.bandwidth - \
+                    (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description="Local fake GitHub server")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8770,
+                        help="Port to listen on (default: 8770)")
+    parser.add_argument("--assets", metavar="N", type=int, default=3,
+                        help="Assets per release (default: 3)")
+    parser.add_argument("--asset-size", metavar="BYTES", type=int,
+                        default=64 * 1024,
+                        help="Size of each asset (default: 65536)")
+    parser.add_argument("--tag", default="v1",
+                        help="Tag of the stable release (default: v1)")
+    parser.add_argument("--latency", metavar="SECONDS", type=float,
+                        default=0.0,
+                        help="Delay before each response (default: 0)")
+    parser.add_argument("--bandwidth", metavar="BYTES", type=int, default=0,
+                        help="Bytes per second per connection "
+                             "(default: unlimited)")
+    parser.add_argument("--zsync", action="store_true",
+                        help="Share most content between tags and publish "
+                             "`.zsync` files, for delta updates")
+    parser.add_argument("--rate-limit", metavar="N", type=int, default=0,
+                        help="API requests allowed per window, for the REST "
+                             "and the GraphQL API each (default: unlimited)")
+    parser.add_argument("--rate-window", metavar="SECONDS", type=float,
+                        default=3600.0,
+                        help="Time until a quota is reset (default: 3600)")
+    parser.add_argument("--secondary-limit", metavar="N", type=int,
+                        default=0,
+                        help="Answer every Nth API request with 429 "
+                             "(default: never)")
+    parser.add_argument("--retry-after", metavar="SECONDS", type=int,
+                        default=1,
+                        help="`Retry-After` of those answers (default: 1)")
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    server = FakeGitHub(
+        (args.host, args.port), assets=args.assets,
+        asset_size=args.asset_size, tag=args.tag, latency=args.latency,
+        bandwidth=args.bandwidth, zsync=args.zsync,
+        rate_limit=args.rate_limit, rate_window=args.rate_window,
+        secondary_limit=args.secondary_limit, retry_after=args.retry_after)
+    print("Serving on {}".format(server.base_url()), flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Measures how long importing hublatest takes on top of the bare interpreter
+# and fails if it exceeds the target or if the download stack gets imported
+# by the paths that should not need it (`--help`, `--check`).
+#
+#     python benchmarks/startup.py --repeat 20 --target 60
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCHMARKS_DIR, "..", "src")
+
+# Modules that only downloads need
+HEAVY_MODULES = ("requests", "urllib3", "tqdm", "asyncio", "aiohttp",
+                 "subprocess", "concurrent.futures", "sqlite3", "http.server")
+
+# Imports the package the way the entry point does, then reports what got
+# loaded after parsing the arguments of the `--check` path
+PROBE = """
+import json, sys
+from hublatest.hublatest import get_arg_parser
+get_arg_parser().parse_args(["--check", "owner/repo"])
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def run_python(code):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], env=env,
+                            stdout=subprocess.PIPE, check=True)
+    return time.perf_counter() - started, result.stdout
+
+
+def measure(code, repeat):
+    run_python(code)
+    return statistics.median(run_python(code)[0] for _ in range(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the import time of hublatest")
+    parser.add_argument("--repeat", metavar="N", type=int, default=10,
+                        help="Runs per measurement (default: 10)")
+    parser.add_argument("--target", metavar="MS", type=float, default=60.0,
+                        help="Largest allowed import time on top of the "
+                             "interpreter, in milliseconds (default: 60)")
+    args = parser.parse_args()
+
+    baseline = measure("pass", args.repeat)
+    package = measure("import hublatest.hublatest", args.repeat)
+    cli = measure("from hublatest.hublatest import get_arg_parser; "
+                  "get_arg_parser()", args.repeat)
+    import_time = (package - baseline) * 1000
+    print("{:<28} {:>8.1f} ms".format("interpreter", baseline * 1000))
+    print("{:<28} {:>8.1f} ms".format("+ import hublatest", import_time))
+    print("{:<28} {:>8.1f} ms".format("+ argument parser",
+                                      (cli - baseline) * 1000))
+
+    loaded = set(json.loads(run_python(PROBE)[1]))
+    heavy = [module for module in HEAVY_MODULES if module in loaded]
+    ok = True
+    if heavy:
+        print("Download stack imported at startup: " + ", ".join(heavy))
+        ok = False
+    if import_time > args.target:
+        print("Import time above the target of {:.0f} ms".format(args.target))
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
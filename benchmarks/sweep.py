@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Runs hublatest against the local fake GitHub with synthetic configs of
+# increasing size and reports wall time, requests, bytes, peak RSS and CPU.
+# Each size is run twice: "cold" downloads everything, "warm" finds nothing
+# new. Arguments after `--` are passed to hublatest.
+#
+#     python benchmarks/sweep.py --repos 10,100,1000 -- --jobs 8
+#     python benchmarks/sweep.py --latency 0.05 -- --engine asyncio -j 32
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from urllib.request import urlopen
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCHMARKS_DIR, "..", "src")
+RUN_MAIN = "import sys; from hublatest.hublatest import main; sys.exit(main())"
+
+
+def start_server(args):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BENCHMARKS_DIR, "fake_github.py"),
+         "--port", str(args.port), "--assets", str(args.assets),
+         "--asset-size", str(args.asset_size),
+         "--latency", str(args.latency), "--bandwidth", str(args.bandwidth)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    server.stdout.readline()
+    return server, "http://127.0.0.1:{}".format(args.port)
+
+
+def get_stats(base_url):
+    with urlopen(base_url + "/_stats") as response:
+        return json.load(response)
+
+
+def write_config(directory, repos):
+    path = os.path.join(directory, "config.ini")
+    with open(path, "w") as f:
+        f.write("[DEFAULT]\n")
+        f.write("version_file_dir = {}\n".format(
+            os.path.join(directory, "versions")))
+        f.write("download_dir = {}\n".format(
+            os.path.join(directory, "downloads")))
+        f.write("use_subdir = true\n\n")
+        for i in range(repos):
+            f.write("[bench/repo{}]\n".format(i))
+    return path
+
+
+def run_hublatest(config_path, base_url, extra_args, log_path):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, GITHUB_TOKEN="benchmark")
+    with open(log_path, "a") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-c", RUN_MAIN, "-c", config_path,
+             "--api-url", base_url,
+             "--graphql-url", base_url + "/graphql"] + extra_args,
+            stdout=log, stderr=log, env=env)
+        # wait4 gives the resource usage of this very child
+        _pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - started
+    max_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {
+        "wall": wall,
+        "cpu": usage.ru_utime + usage.ru_stime,
+        "max_rss": max_rss,
+        "exit_code": os.waitstatus_to_exitcode(status)
+        if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark sweeps against a local fake GitHub")
+    parser.add_argument("--repos", default="10,100,1000",
+                        help="Comma-separated config sizes "
+                             "(default: 10,100,1000)")
+    parser.add_argument("--assets", metavar="N", type=int, default=3,
+                        help="Assets per release (default: 3)")
+    parser.add_argument("--asset-size", metavar="BYTES", type=int,
+                        default=64 * 1024,
+                        help="Size of each asset (default: 65536)")
+    parser.add_argument("--latency", metavar="SECONDS", type=float,
+                        default=0.0,
+                        help="Delay before each response (default: 0)")
+    parser.add_argument("--bandwidth", metavar="BYTES", type=int, default=0,
+                        help="Bytes per second per connection "
+                             "(default: unlimited)")
+    parser.add_argument("--port", type=int, default=8770,
+                        help="Port of the fake server (default: 8770)")
+    parser.add_argument("--json", metavar="PATH",
+                        help="Also write the results to this file")
+    parser.add_argument("hublatest_args", nargs=argparse.REMAINDER,
+                        help="Arguments after `--` are passed to hublatest")
+    args = parser.parse_args()
+    extra_args = args.hublatest_args
+    if extra_args[:1] == ["--"]:
+        extra_args = extra_args[1:]
+
+    server, base_url = start_server(args)
+    results = []
+    print("{:>6} {:<5} {:>8} {:>6} {:>6} {:>7} {:>9} {:>8} {:>7} {:>4}".format(
+        "repos", "run", "wall s", "api", "304", "assets", "MB", "RSS MB",
+        "CPU s", "rc"))
+    try:
+        for repos in [int(n) for n in args.repos.split(",")]:
+            with tempfile.TemporaryDirectory() as directory:
+                config_path = write_config(directory, repos)
+                log_path = os.path.join(directory, "hublatest.log")
+                for run in ("cold", "warm"):
+                    before = get_stats(base_url)
+                    result = run_hublatest(
+                        config_path, base_url, extra_args, log_path)
+                    after = get_stats(base_url)
+                    result.update({
+                        key: after[key] - before[key] for key in after})
+                    result.update({"repos": repos, "run": run})
+                    results.append(result)
+                    print("{:>6} {:<5} {:>8.2f} {:>6} {:>6} {:>7} {:>9.1f} "
+                          "{:>8.1f} {:>7.2f} {:>4}".format(
+                              repos, run, result["wall"],
+                              result["api_requests"] +
+                              result["graphql_requests"],
+                              result["not_modified"],
+                              result["asset_requests"],
+                              result["bytes_sent"] / 1e6,
+                              result["max_rss"] / 1e6, result["cpu"],
+                              result["exit_code"]), flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
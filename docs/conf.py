@@ -1 +1,27 @@
-extensions = ["sphinxarg.ext", "sphinx_markdown_builder"]
\ No newline at end of file
+from docutils import nodes
+
+extensions = ["sphinxarg.ext", "sphinx_markdown_builder"]
+
+
+# The Markdown builder has no option lists, which the argparse directive
+# emits for the commandline options
+def visit_option_list_item(self, node):
+    names = ", ".join(
+        option.astext() for option in node.traverse(nodes.option_string))
+    # The first child of each paragraph is the help text spaced out by
+    # sphinx-argparse, followed by the parsed Markdown
+    text = "\n\n   ".join(
+        "".join(
+            "`{}`".format(child.astext()) if isinstance(child, nodes.literal)
+            else child.astext()
+            for child in paragraph.children[1:])
+        for paragraph in node.traverse(nodes.paragraph))
+    self.add("*  **`{}`**\n\n   {}\n\n".format(names, text))
+    raise nodes.SkipNode
+
+
+def setup(app):
+    from sphinx_markdown_builder.markdown_writer import MarkdownTranslator
+    MarkdownTranslator.visit_option_list = lambda self, node: None
+    MarkdownTranslator.depart_option_list = lambda self, node: None
+    MarkdownTranslator.visit_option_list_item = visit_option_list_item
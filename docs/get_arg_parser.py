@@ -1,11 +1,14 @@
-import imp
-import gettext
+import importlib
 import os
+import sys
+
+sys.path.insert(0, os.path.join("..", "src"))
 
 
 def get_arg_parser():
-    hublatest = imp.load_source("hublatest", "../src/hublatest/hublatest.py")
-    return hublatest.get_arg_parser()
+    # Imported again each time, as the translation is picked at import
+    import hublatest.hublatest
+    return importlib.reload(hublatest.hublatest).get_arg_parser()
 
 
 def get_arg_parser_zh_cn():
@@ -34,7 +34,10 @@ setuptools.setup(
         ]
     },
     install_requires=[
-        "tqdm",
+        "tqdm>=4.60",
         "requests"
-    ]
+    ],
+    extras_require={
+        "aio": ["aiohttp"]
+    }
 )
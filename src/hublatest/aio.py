@@ -0,0 +1,409 @@
+import aiohttp
+import asyncio
+import logging
+import os
+import time
+import traceback
+
+from asyncio.subprocess import PIPE
+from urllib.parse import urlsplit
+from .file_download import MAX_CHUNK_SIZE, FileDownload
+from .hooks import NEW_SESSION, kill_hook, log_line
+from .ratelimit import RateLimited, RateLimiter
+from .hublatest import (
+    _, ApiResponse, DownloadRepoRelease, RepoLoggerAdapter,
+    get_repo_arguments, iter_release_lookups, parse_checksums)
+
+
+# Longest line of hook output read at once
+HOOK_LINE_LIMIT = 1024 * 1024
+# Received data is collected up to this size before it is written and
+# hashed off the event loop
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class Limits:
+
+    def __init__(self, max_downloads, per_host, hook_jobs=1):
+        self.downloads = \
+            asyncio.Semaphore(max_downloads) if max_downloads > 0 else None
+        self.per_host = per_host
+        self.hosts = {}
+        # Hooks run as background tasks that are awaited at the end
+        self.hooks = asyncio.Semaphore(hook_jobs)
+        self.hook_tasks = set()
+
+    def host(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(self.per_host)
+        return self.hosts[host]
+
+    async def wait_hooks(self):
+        while self.hook_tasks:
+            await asyncio.wait(self.hook_tasks)
+
+
+class AsyncFileDownload(FileDownload):
+
+    async def __call__(self, url, file_path, session, limits,
+                       length=None, updated_at=None, sha256=None,
+                       bandwidth=None):
+        self.session = session
+        self.limits = limits
+        self.bandwidth = bandwidth
+        resume = self.prepare(url, file_path, length, updated_at)
+        actual_sha256 = await self.download(resume)
+        return self.finish(actual_sha256, sha256)
+
+    async def download(self, resume=False):
+        # Hashing a resumed file and writing are done in the default
+        # executor, so that other downloads carry on meanwhile
+        loop = asyncio.get_event_loop()
+        f, total_size = await loop.run_in_executor(
+            None, self.open_part_file, resume)
+        with f:
+            while f.tell() != total_size:
+                headers = {}
+                downloaded_bytes = f.tell()
+                if downloaded_bytes:
+                    headers['Range'] = f'bytes={downloaded_bytes}-'
+                async with self.limits.host(self.url), \
+                        self.session.get(self.url, headers=headers) \
+                        as response:
+                    downloaded_bytes, total_size = await loop.run_in_executor(
+                        None, self.check_response, f, response.status,
+                        int(response.headers.get('content-length')),
+                        downloaded_bytes, total_size)
+                    await loop.run_in_executor(
+                        None, self.preallocate, f, total_size)
+
+                    self.progress_bar = self.create_progress_bar(total_size)
+                    self.progress_bar.update(downloaded_bytes)
+
+                    # Whatever has arrived is taken at once, so chunks
+                    # grow with the speed of the link, unless they are cut
+                    # into slices to share a rate
+                    chunks = response.content.iter_any()
+                    if self.bandwidth is not None:
+                        chunks = response.content.iter_chunked(
+                            self.bandwidth.get_slice_size(MAX_CHUNK_SIZE))
+                    buffer = bytearray()
+                    with self.progress_bar:
+                        try:
+                            async for chunk in chunks:
+                                buffer += chunk
+                                if len(buffer) >= WRITE_BUFFER_SIZE:
+                                    await loop.run_in_executor(
+                                        None, self.write_chunk, f, buffer)
+                                    buffer = bytearray()
+                                if self.bandwidth is not None:
+                                    await asyncio.sleep(
+                                        self.bandwidth.reserve(len(chunk)))
+                        finally:
+                            await loop.run_in_executor(
+                                None, self.write_rest, f, buffer)
+        return self.sha256.hexdigest()
+
+    def write_rest(self, f, buffer):
+        if buffer:
+            self.write_chunk(f, buffer)
+        self.checkpoint(f)
+        self.flush_progress()
+
+
+class AsyncDownloadRepoRelease(DownloadRepoRelease):
+
+    async def __call__(self, *args, limits=None, **kwargs):
+        self.setup(*args, **kwargs)
+        # Hooks of a call made with its own limits are awaited before it
+        # returns, as nothing else would wait for them
+        own_limits = limits is None
+        self.limits = limits if limits is not None else Limits(0, 10)
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter()
+        if self.segments > 1:
+            self.logger.debug(
+                _("Segmented downloads are not supported by the asyncio "
+                  "engine, using one connection per file."))
+        if self.delta:
+            self.logger.debug(
+                _("Delta updates are not supported by the asyncio engine, "
+                  "downloading whole files."))
+
+        # Like the threads engine, a session is made when none is shared
+        own_session = self.session is None
+        if own_session:
+            self.session = aiohttp.ClientSession()
+        try:
+            with self.metrics.track():
+                changed = await self.run()
+                self.metrics.record_result(changed)
+        finally:
+            if own_limits:
+                await self.limits.wait_hooks()
+            if own_session:
+                await self.session.close()
+        return changed
+
+    async def run(self):
+        os.makedirs(self.download_dir, 0o755, True)
+        with self.metrics.phase("api"):
+            release = self.release or await self.get_release()
+        if release is None:
+            self.skip_not_modified()
+            return False
+        self.load_release(release)
+
+        if not self.state:
+            self.logger.debug(
+                _("No --version-file-dir specified, will download only."))
+            with self.metrics.phase("download"):
+                await self.download_files()
+            return True
+
+        # Comparing local files may hash them, so keep it off the event loop
+        with self.metrics.phase("check"):
+            if self.verify:
+                await self.load_checksums()
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.check_local_files)
+        if self.files_needed:
+            with self.metrics.phase("download"):
+                await self.download_files()
+        else:
+            self.logger.info(_("No new releases need to be downloaded."))
+
+        self.find_files_to_remove()
+        if self.files_to_remove:
+            with self.metrics.phase("remove"):
+                await self.remove_old_files()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.remove_stale_parts)
+
+        with self.metrics.phase("save"):
+            await loop.run_in_executor(None, self.save_state)
+        return self.is_changed()
+
+    async def get_release(self):
+        lookup = self.lookup_release()
+        try:
+            request = next(lookup)
+            while True:
+                request = lookup.send(await self.request_api(*request))
+        except StopIteration as e:
+            return e.value
+
+    async def request_api(self, url, first=False):
+        return await self.try_coroutine(
+            self.get_api_response, [url, self.get_api_headers(url, first)])
+
+    async def get_api_response(self, url, headers):
+        await asyncio.sleep(self.rate_limiter.reserve())
+        async with self.limits.host(url), \
+                self.session.get(url, headers=headers) as response:
+            delay = self.rate_limiter.update(response.status, response.headers)
+            if delay is not None:
+                raise RateLimited(delay)
+            if response.status not in (200, 304, 404):
+                raise Exception(_("API request failed, returned: {}.").format(
+                    response.status))
+            data = None
+            if response.status == 200:
+                data = await response.json(content_type=None)
+            return ApiResponse(response.status, response.headers.copy(), data)
+
+    async def load_checksums(self):
+        if self.checksums is None:
+            self.checksums = {}
+            if self.checksums_url:
+                self.checksums = parse_checksums(await self.try_coroutine(
+                    self.get_text, [self.checksums_url]))
+
+    async def get_text(self, url):
+        async with self.limits.host(url), self.session.get(url) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def download_files(self):
+        await self.load_checksums()
+        asset_slots = asyncio.Semaphore(self.asset_jobs)
+        tasks = [
+            asyncio.ensure_future(self.download_file(
+                url, file, self.get_expected_hash(file), asset_slots))
+            for url, file in self.files_needed.items()]
+        downloaded_files = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                self.finish_download(*await next_done, downloaded_files)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+        self.finish_downloads(downloaded_files)
+
+    async def download_file(self, url, file, expected_hash, asset_slots):
+        loop = asyncio.get_event_loop()
+        if await loop.run_in_executor(
+                None, self.link_stored_file, file, expected_hash):
+            return url, expected_hash
+        async with asset_slots:
+            if self.limits.downloads:
+                await self.limits.downloads.acquire()
+            try:
+                self.logger.info(_("Downloading: {}").format(url))
+                file_path = os.path.join(self.download_dir, file.filename)
+                started = time.monotonic()
+                download = AsyncFileDownload()
+                sha256 = await self.try_coroutine(
+                    download,
+                    [url, file_path, self.session, self.limits, file.length,
+                     file.updated_at, expected_hash, self.bandwidth])
+                self.metrics.record_asset(
+                    file.filename, download.received,
+                    time.monotonic() - started)
+            finally:
+                if self.limits.downloads:
+                    self.limits.downloads.release()
+        await loop.run_in_executor(None, self.store_file, file_path, sha256)
+        return url, sha256
+
+    async def try_coroutine(self, function, params):
+        attempt = 0
+        while True:
+            try:
+                return await function(*params)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await asyncio.sleep(self.get_retry_delay(e, attempt))
+                if not isinstance(e, RateLimited):
+                    attempt += 1
+
+    async def remove_old_files(self):
+        # Hooks are started on the event loop once the files are removed
+        removed_files = await asyncio.get_event_loop().run_in_executor(
+            None, self.delete_old_files)
+        self.finish_removals(removed_files)
+
+    def exec_commands(self, cmd_template, files, is_remove=False):
+        cmd = self.format_command(cmd_template, files, is_remove)
+        self.logger.debug(_("Executing command: {}").format(cmd))
+        task = asyncio.ensure_future(
+            self.run_command(cmd, self.metrics.phase("hooks")))
+        self.limits.hook_tasks.add(task)
+        task.add_done_callback(self.limits.hook_tasks.discard)
+
+    async def run_command(self, cmd, phase):
+        async with self.limits.hooks:
+            with phase:
+                try:
+                    returncode = await run_hook(
+                        cmd, self.logger, self.hook_timeout)
+                except OSError as e:
+                    self.logger.error(
+                        _("Failed to execute command `{0}`: {1}").format(
+                            cmd, e))
+                    return
+        self.log_command_result(cmd, returncode)
+
+
+async def run_hook(cmd, logger, timeout=None):
+    # Returns the exit code, or None if the timeout was hit
+    process = await asyncio.create_subprocess_shell(
+        cmd, stdout=PIPE, stderr=PIPE, limit=HOOK_LINE_LIMIT,
+        start_new_session=NEW_SESSION)
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            log_lines(process.stdout, logger.debug),
+            log_lines(process.stderr, logger.info),
+            process.wait()), timeout or None)
+    except asyncio.TimeoutError:
+        kill_hook(process)
+        await process.wait()
+        return None
+    return process.returncode
+
+
+async def log_lines(stream, log):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        log_line(line, log)
+
+
+async def download_repo_release(*args, **kwargs):
+    return await AsyncDownloadRepoRelease()(*args, **kwargs)
+
+
+async def process_repository(repo_identifier, options, repo_options,
+                             repo_slots, **kwargs):
+    async with repo_slots:
+        logger = RepoLoggerAdapter(logging.getLogger(),
+                                   {"repo": repo_identifier})
+        logger.info(_("Processing: {}").format(repo_identifier))
+        try:
+            await download_repo_release(
+                logger=logger,
+                **get_repo_arguments(repo_identifier, options, repo_options),
+                **kwargs
+            )
+        except Exception as e:
+            logger.warning(_("Error occurred: {}").format(e))
+            logger.debug(traceback.format_exc())
+            return -1
+        return 0
+
+
+async def lookup_releases(repositories, options, session, graphql_url, token,
+                          rate_limiter):
+    lookup = iter_release_lookups(repositories, options)
+    try:
+        query = next(lookup)
+        while True:
+            try:
+                result = await post_query(
+                    query, session, graphql_url, token, rate_limiter)
+            except Exception as e:
+                result = e
+            query = lookup.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+async def post_query(query, session, graphql_url, token, rate_limiter):
+    await asyncio.sleep(rate_limiter.reserve())
+    async with session.post(
+            graphql_url, json=query,
+            headers={"Authorization": "bearer " + token}) as response:
+        rate_limiter.update(response.status, response.headers)
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+async def run_repositories(repositories, options, jobs, max_downloads,
+                           bandwidth, hook_jobs, pool_size, timeout, token,
+                           graphql, graphql_url, state, metrics=None):
+    limits = Limits(max_downloads, pool_size, hook_jobs)
+    rate_limiter = RateLimiter()
+    repo_slots = asyncio.Semaphore(jobs)
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=pool_size)
+    client_timeout = aiohttp.ClientTimeout(
+        sock_connect=timeout, sock_read=timeout)
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=client_timeout) as session:
+        releases = {}
+        if graphql:
+            releases = await lookup_releases(repositories, options, session,
+                                             graphql_url, token, RateLimiter())
+        results = await asyncio.gather(*[
+            process_repository(repo_identifier, options, repo_options,
+                               repo_slots, session=session,
+                               rate_limiter=rate_limiter, token=token,
+                               release=releases.get(repo_identifier),
+                               bandwidth=bandwidth, metrics=metrics,
+                               state=state, limits=limits)
+            for repo_identifier, repo_options in repositories.items()])
+    await limits.wait_hooks()
+    return -1 if any(results) else 0
@@ -0,0 +1,126 @@
+import re
+import threading
+import time
+
+
+RATE_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)([KMG]?)(?:I?B)?(?:/S)?$")
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+SCHEDULE_TIME_PATTERN = re.compile(r"^(\d{1,2}):(\d{2})$")
+MINUTES_PER_DAY = 24 * 60
+
+# Time a stream idle for a while may catch up on at once
+BURST_TIME = 0.5
+# Reads are cut to this share of a second at the current rate, so that
+# streams take turns in small slices and share the rate evenly
+SLICE_TIME = 0.1
+MIN_SLICE_SIZE = 16 * 1024
+
+
+# Shared by every download it limits, which each reserve what they just
+# received and wait until it fits in the rate. Reservations are granted in
+# the order they come, so streams reading slices of the same size get the
+# same share, and what an idle or slow stream leaves is taken by the others.
+class BandwidthLimiter:
+
+    def __init__(self, schedule=None, parent=None):
+        # A limiter of a repository also counts against the global one
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.set_schedule(schedule or [])
+
+    def set_schedule(self, schedule):
+        with self.lock:
+            self.schedule = schedule
+            self.rate = None
+            self.slice_size = None
+            self.next_change = 0.0
+            self.next_send = 0.0
+
+    def reserve(self, size):
+        # Returns how long to wait before reading on
+        delay = 0.0
+        if self.parent is not None:
+            delay = self.parent.reserve(size)
+        with self.lock:
+            if time.time() >= self.next_change:
+                self.update_rate()
+            if not self.rate:
+                return delay
+            now = time.monotonic()
+            start = max(self.next_send, now - BURST_TIME)
+            self.next_send = start + size / self.rate
+            return max(delay, self.next_send - now)
+
+    def wait(self, size):
+        delay = self.reserve(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_slice_size(self, chunk_size):
+        with self.lock:
+            if time.time() >= self.next_change:
+                self.update_rate()
+            if self.slice_size is not None:
+                chunk_size = min(chunk_size, self.slice_size)
+        if self.parent is not None:
+            chunk_size = self.parent.get_slice_size(chunk_size)
+        return chunk_size
+
+    def update_rate(self):
+        if not self.schedule:
+            self.next_change = float("inf")
+            return
+        now = time.time()
+        local_time = time.localtime(now)
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        # Before the first entry of the day, the last one still applies
+        rate = self.schedule[-1][1]
+        next_minute = self.schedule[0][0] + MINUTES_PER_DAY
+        for start, entry_rate in self.schedule:
+            if start > minute:
+                next_minute = start
+                break
+            rate = entry_rate
+        self.next_change = now - now % 60 + (next_minute - minute) * 60
+        if rate != self.rate:
+            self.rate = rate
+            self.slice_size = None
+            if rate:
+                self.slice_size = max(MIN_SLICE_SIZE, int(rate * SLICE_TIME))
+            self.next_send = time.monotonic()
+
+
+def parse_rate(value):
+    # Bytes per second, with an optional K, M or G suffix (powers of 1024);
+    # 0 or `off` means unlimited
+    if value.strip().upper() == "OFF":
+        return 0
+    match = RATE_PATTERN.match(value.strip().upper())
+    if not match:
+        raise Exception("Invalid rate: {}".format(value))
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
+
+
+def parse_schedule(value):
+    # Either a single rate, or `HH:MM,RATE` entries separated by spaces that
+    # each apply from their time of day until the next one, like
+    # `08:00,5M 19:00,50M 23:30,off`
+    if not value or not value.strip():
+        return []
+    entries = value.split()
+    if len(entries) == 1 and "," not in entries[0]:
+        rate = parse_rate(entries[0])
+        return [(0, rate)] if rate else []
+    schedule = []
+    for entry in entries:
+        time_of_day, _, rate = entry.partition(",")
+        match = SCHEDULE_TIME_PATTERN.match(time_of_day)
+        if not match or not rate or int(match.group(1)) > 23 or \
+                int(match.group(2)) > 59:
+            raise Exception("Invalid schedule entry: {}".format(entry))
+        schedule.append(
+            (int(match.group(1)) * 60 + int(match.group(2)), parse_rate(rate)))
+    schedule.sort()
+    if not any(rate for _start, rate in schedule):
+        return []
+    return schedule
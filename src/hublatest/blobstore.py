@@ -0,0 +1,75 @@
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+BLOB_STORE_DIR = ".blobs"
+
+# ioctl of Linux that makes a copy-on-write clone of a file (Btrfs, XFS)
+FICLONE = 0x40049409
+
+
+# Assets are kept once per content under `<root>/ab/abcdef...` and the files
+# in the download directories are hard links to them. A blob that has no
+# other link left is no longer referenced and can be collected.
+class BlobStore:
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def link(self, sha256, file_path):
+        # Returns whether the file could be created from a stored blob
+        blob_path = self.get_path(sha256)
+        temp_path = file_path + ".link"
+        try:
+            os.link(blob_path, temp_path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # e.g. too many links to the blob
+            if not clone_file(blob_path, temp_path):
+                return False
+        os.replace(temp_path, file_path)
+        return True
+
+    def add(self, file_path, sha256):
+        blob_path = self.get_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), 0o755, True)
+        try:
+            os.link(file_path, blob_path)
+        except FileExistsError:
+            # Downloaded at the same time for another repository
+            if not os.path.samefile(file_path, blob_path):
+                self.link(sha256, file_path)
+
+    def collect_garbage(self):
+        removed = freed = 0
+        for dir_path, _dir_names, filenames in os.walk(self.root):
+            for filename in filenames:
+                blob_path = os.path.join(dir_path, filename)
+                stat = os.stat(blob_path)
+                if stat.st_nlink == 1:
+                    os.remove(blob_path)
+                    removed += 1
+                    freed += stat.st_size
+        return removed, freed
+
+
+def clone_file(source_path, target_path):
+    if fcntl is None:
+        return False
+    try:
+        with open(source_path, "rb") as source, \
+                open(target_path, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        return False
+    return True
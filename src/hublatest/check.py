@@ -0,0 +1,113 @@
+import logging
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from .hublatest import (
+    _, EXIT_UPDATES, ApiResponse, DownloadRepoRelease, RepoLoggerAdapter,
+    get_repo_arguments, lookup_releases)
+from .ratelimit import RateLimiter
+
+
+# Stands in for the requests session with the standard library, so that a
+# check does not load the download stack
+class UrllibSession:
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def get(self, url, headers=None):
+        return self.request(Request(url, headers=headers or {}))
+
+    def post(self, url, json=None, headers=None):
+        headers = dict(headers or {}, **{"Content-Type": "application/json"})
+        return self.request(
+            Request(url, data=dumps(json).encode(), headers=headers))
+
+    def request(self, request):
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return ApiResponse(response.status, response.headers,
+                                   load_json(response.read()))
+        except HTTPError as e:
+            with e:
+                return ApiResponse(e.code, e.headers, load_json(e.read()))
+
+
+# Looks up the release like a download would and reports what it would do
+class CheckRepoRelease(DownloadRepoRelease):
+
+    def __call__(self, *args, **kwargs):
+        # Hashing local files is left to the actual run
+        self.setup(*args, **dict(kwargs, verify=False))
+        release = self.release or self.get_release()
+        if release is None:
+            local_version = self.record.get("version")
+            return {
+                "update": False,
+                "local_version": local_version,
+                "latest_version": local_version
+            }
+        self.load_release(release)
+        self.check_local_files()
+        self.find_files_to_remove()
+        return {
+            "update": self.is_changed(),
+            "local_version": self.local_version,
+            "latest_version": self.latest_version,
+            "files": sorted(
+                file.filename for file in self.files_needed.values()),
+            "removed": sorted(file.filename for file in self.files_to_remove)
+        }
+
+
+def load_json(data):
+    try:
+        return loads(data)
+    except ValueError:
+        return None
+
+
+def check_repository(repo_identifier, options, repo_options, **kwargs):
+    logger = RepoLoggerAdapter(logging.getLogger(), {"repo": repo_identifier})
+    logger.info(_("Checking: {}").format(repo_identifier))
+    try:
+        return CheckRepoRelease()(
+            logger=logger,
+            **get_repo_arguments(repo_identifier, options, repo_options),
+            **kwargs
+        )
+    except Exception as e:
+        logger.warning(_("Error occurred: {}").format(e))
+        logger.debug(traceback.format_exc())
+        return {"update": None, "error": str(e)}
+
+
+def check_repositories(repositories, options, jobs, timeout, token, graphql,
+                       graphql_url, state):
+    session = UrllibSession(timeout)
+    rate_limiter = RateLimiter()
+    releases = {}
+    if graphql:
+        releases = lookup_releases(repositories, options, session,
+                                   graphql_url, token, RateLimiter())
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            repo_identifier: executor.submit(
+                check_repository, repo_identifier, options, repo_options,
+                session=session, rate_limiter=rate_limiter, token=token,
+                release=releases.get(repo_identifier), state=state)
+            for repo_identifier, repo_options in repositories.items()}
+        results = {
+            repo_identifier: future.result()
+            for repo_identifier, future in futures.items()}
+    print(dumps(results, indent=2))
+
+    if any("error" in result for result in results.values()):
+        return -1
+    if any(result["update"] for result in results.values()):
+        return EXIT_UPDATES
+    return 0
@@ -0,0 +1,195 @@
+import heapq
+import logging
+import random
+import signal
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from .hublatest import (
+    _, RepoLoggerAdapter, collect_garbage, download_repo_release,
+    get_repo_arguments, load_config, write_metrics)
+from .bandwidth import parse_schedule
+from .hooks import HookRunner
+from .ratelimit import RateLimiter
+from .session import Session
+
+
+# Interval of a repository is multiplied by this after each check that
+# found no new release, and reset to the minimum when one is found
+INTERVAL_GROWTH = 2.0
+INTERVAL_JITTER = 0.1
+
+
+class Daemon:
+
+    def __init__(self, config_path, parsed_args, jobs, max_downloads,
+                 bandwidth, hook_jobs, pool_size, timeout, token, graphql,
+                 graphql_url, state, metrics=None, prometheus_file=None,
+                 prometheus_port=0):
+        self.config_path = config_path
+        self.parsed_args = parsed_args
+        self.jobs = jobs
+        self.bandwidth = bandwidth
+        self.state = state
+        self.metrics = metrics
+        self.prometheus_file = prometheus_file
+        self.prometheus_port = prometheus_port
+        self.hook_runner = HookRunner(hook_jobs)
+
+        # Connections and the rate limits are kept across checks
+        self.kwargs = {
+            "download_slots":
+                BoundedSemaphore(max_downloads) if max_downloads > 0 else None,
+            "bandwidth": bandwidth,
+            "hook_runner": self.hook_runner,
+            "session": Session(pool_size=pool_size, timeout=timeout),
+            "rate_limiter": RateLimiter(),
+            "token": token,
+            "metrics": metrics,
+            "state": state
+        }
+
+        self.repositories = {}
+        self.options = {}
+        self.intervals = {}
+        self.queue = []
+        self.running = {}
+        self.wakeup = threading.Event()
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def __call__(self, repositories, options):
+        self.load(repositories, options)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        if self.prometheus_port:
+            self.metrics.serve_prometheus(self.prometheus_port)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while not self.stop_requested:
+                if self.reload_requested:
+                    self.reload()
+                self.start_due_checks(executor)
+                timeout = None
+                if self.queue:
+                    timeout = max(0, self.queue[0][0] - time.monotonic())
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+                self.collect_finished_checks()
+            logging.info(_("Stopping, waiting for running checks to finish."))
+        self.collect_finished_checks()
+        self.hook_runner.shutdown()
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+        self.wakeup.set()
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+        self.wakeup.set()
+
+    def reload(self):
+        self.reload_requested = False
+        logging.info(_("Reloading the config file."))
+        try:
+            options, repositories = load_config(
+                self.config_path, self.parsed_args)
+            schedule = parse_schedule(options.pop("max_rate"))
+        except Exception as e:
+            logging.error(
+                _("Failed to reload the config file, keeping the current "
+                  "one: {}").format(e))
+            return
+        self.bandwidth.set_schedule(schedule)
+        self.load(repositories, options)
+
+    def load(self, repositories, options):
+        self.repositories = repositories
+        self.options = options
+        for repo_identifier in list(self.intervals):
+            if repo_identifier not in repositories:
+                del self.intervals[repo_identifier]
+        # Repositories new to the list are checked right away
+        scheduled = {item[1] for item in self.queue}
+        for repo_identifier in repositories:
+            if repo_identifier not in scheduled and \
+                    repo_identifier not in self.running.values():
+                self.schedule(repo_identifier, 0)
+        logging.info(_("Watching {} repositories.").format(len(repositories)))
+
+    def get_bounds(self, repo_identifier):
+        repo_options = self.repositories[repo_identifier]
+        min_interval = repo_options.get(
+            "min_interval", self.options["min_interval"])
+        max_interval = repo_options.get(
+            "max_interval", self.options["max_interval"])
+        return min_interval, max(min_interval, max_interval)
+
+    def schedule(self, repo_identifier, delay):
+        heapq.heappush(
+            self.queue, (time.monotonic() + delay, repo_identifier))
+
+    def start_due_checks(self, executor):
+        now = time.monotonic()
+        while self.queue and self.queue[0][0] <= now and \
+                len(self.running) < self.jobs:
+            _due, repo_identifier = heapq.heappop(self.queue)
+            # Dropped from the config file by a reload
+            if repo_identifier not in self.repositories:
+                continue
+            future = executor.submit(self.check, repo_identifier,
+                                     self.repositories[repo_identifier],
+                                     self.options)
+            future.add_done_callback(lambda future: self.wakeup.set())
+            self.running[future] = repo_identifier
+
+    def collect_finished_checks(self):
+        finished = [future for future in self.running if future.done()]
+        for future in finished:
+            repo_identifier = self.running.pop(future)
+            if repo_identifier in self.repositories:
+                self.reschedule(repo_identifier, future.result())
+        if self.state:
+            self.state.flush()
+        # Only changed releases can leave blobs unreferenced
+        if any(future.result() for future in finished):
+            collect_garbage(self.repositories, self.options)
+        if finished and self.prometheus_file:
+            write_metrics(self.metrics, prometheus_file=self.prometheus_file)
+
+    def reschedule(self, repo_identifier, changed):
+        min_interval, max_interval = self.get_bounds(repo_identifier)
+        interval = self.intervals.get(repo_identifier, min_interval)
+        if changed:
+            interval = min_interval
+        elif changed is not None:
+            interval = interval * INTERVAL_GROWTH
+        interval = min(max_interval, max(min_interval, interval))
+        self.intervals[repo_identifier] = interval
+        logger = RepoLoggerAdapter(logging.getLogger(),
+                                   {"repo": repo_identifier})
+        logger.debug(
+            _("Next check in {:.0f} seconds.").format(interval))
+        self.schedule(repo_identifier, interval * random.uniform(
+            1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER))
+
+    def check(self, repo_identifier, repo_options, options):
+        # Returns whether a new release was found, or None on failure
+        logger = RepoLoggerAdapter(logging.getLogger(),
+                                   {"repo": repo_identifier})
+        logger.info(_("Processing: {}").format(repo_identifier))
+        try:
+            return download_repo_release(
+                logger=logger,
+                **get_repo_arguments(repo_identifier, options, repo_options),
+                **self.kwargs
+            )
+        except Exception as e:
+            logger.warning(_("Error occurred: {}").format(e))
+            logger.debug(traceback.format_exc())
+            return None
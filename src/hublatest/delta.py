@@ -0,0 +1,366 @@
+import hashlib
+import io
+import mmap
+import os
+import re
+import struct
+import time
+
+from itertools import accumulate
+from .file_download import CHUNK_SIZE
+
+
+# Missing ranges asked for in one multi-range request
+MAX_RANGES_PER_REQUEST = 64
+# Missing blocks closer than this are fetched as one range
+RANGE_GAP = 4 * 1024
+# Scanning the old file is slow where it does not match, so after the
+# first PROBE_SIZE bytes and then every SCAN_CHECK_SIZE bytes the scan is
+# given up for a full download if less than MIN_MATCH_RATIO of the bytes
+# scanned so far were found in the new file. Past SCAN_TIME_LIMIT seconds
+# the blocks found so far are used and the rest is downloaded.
+PROBE_SIZE = 1024 * 1024
+SCAN_CHECK_SIZE = 256 * 1024
+MIN_MATCH_RATIO = 0.5
+SCAN_TIME_LIMIT = 30.0
+DELTA_FILE_SUFFIX = ".delta"
+
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?')
+
+
+class ZsyncFile:
+
+    def __init__(self, data):
+        header, separator, self.checksums = data.partition(b"\n\n")
+        if not separator:
+            raise Exception("Malformed zsync file")
+        self.headers = {}
+        for line in header.decode("utf-8").splitlines():
+            key, _, value = line.partition(":")
+            self.headers[key.strip().lower()] = value.strip()
+        if "z-map2" in self.headers:
+            raise Exception("Compressed zsync files are not supported")
+        self.block_size = int(self.headers["blocksize"])
+        self.length = int(self.headers["length"])
+        self.sha1 = self.headers.get("sha-1")
+        self.seq_matches, self.rsum_bytes, self.checksum_bytes = (
+            int(value) for value in
+            self.headers.get("hash-lengths", "1,4,16").split(","))
+        self.blocks = (self.length + self.block_size - 1) // self.block_size
+        self.rsum_mask = (1 << 8 * self.rsum_bytes) - 1
+        self.parse_checksums()
+
+    def parse_checksums(self):
+        entry_size = self.rsum_bytes + self.checksum_bytes
+        if len(self.checksums) < self.blocks * entry_size:
+            raise Exception("Truncated zsync file")
+        self.rsums = []
+        self.strong = []
+        self.index = {}
+        for i in range(self.blocks):
+            entry = self.checksums[i * entry_size:(i + 1) * entry_size]
+            rsum = int.from_bytes(entry[:self.rsum_bytes], "big")
+            self.rsums.append(rsum)
+            self.strong.append(entry[self.rsum_bytes:])
+            self.index.setdefault(rsum, []).append(i)
+
+    def get_block_length(self, i):
+        return min(self.block_size, self.length - i * self.block_size)
+
+
+# Rebuilds a file described by a zsync file from an older local copy,
+# fetching only the blocks not found in it with multi-range requests
+class DeltaDownload:
+
+    def __call__(self, url, file_path, seed_path, zsync_data, session,
+                 sha256=None, bandwidth=None):
+        # Returns the SHA-256 and the number of bytes downloaded, or None if
+        # the old copy has too little in common with the new file
+        self.zsync = ZsyncFile(zsync_data)
+        self.session = session
+        self.bandwidth = bandwidth
+        temp_path = file_path + DELTA_FILE_SUFFIX
+        try:
+            with open(seed_path, "rb") as seed_file:
+                if os.fstat(seed_file.fileno()).st_size < \
+                        self.zsync.block_size:
+                    return None
+                with mmap.mmap(seed_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as seed:
+                    found = self.find_blocks(seed)
+                    if not found:
+                        return None
+                    with open(temp_path, "wb") as f:
+                        f.truncate(self.zsync.length)
+                        self.copy_blocks(seed, found, f)
+                        downloaded = self.fetch_blocks(url, found, f)
+            actual_sha256 = self.check_file(temp_path, sha256)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return actual_sha256, downloaded
+
+    def find_blocks(self, seed):
+        # Maps the index of each block found in the old copy to its offset
+        # there, looking at every offset with the rolling checksum of zsync;
+        # returns None if too little of it matches
+        zsync = self.zsync
+        block_size = zsync.block_size
+        mask = zsync.rsum_mask
+        index = zsync.index
+        check_next = zsync.seq_matches > 1
+        found = {}
+        end = len(seed)
+        position = 0
+        next_block = None
+        matched_bytes = 0
+        next_check = PROBE_SIZE
+        started = time.monotonic()
+        a, b = get_rsum(seed[0:block_size])
+        a2 = b2 = 0
+        if check_next and 2 * block_size <= end:
+            a2, b2 = get_rsum(seed[block_size:2 * block_size])
+        while position + block_size <= end:
+            if position >= next_check:
+                if matched_bytes < position * MIN_MATCH_RATIO:
+                    return None
+                if time.monotonic() - started > SCAN_TIME_LIMIT:
+                    break
+                next_check = position + SCAN_CHECK_SIZE
+            candidates = index.get(((a << 16) | b) & mask)
+            if candidates is not None:
+                matched = self.match_blocks(
+                    seed, position, candidates,
+                    ((a2 << 16) | b2) & mask if check_next else None,
+                    next_block)
+                next_block = None
+                if matched:
+                    for i in matched:
+                        found.setdefault(i, position)
+                    next_block = matched[0] + 1
+                    matched_bytes += block_size
+                    position += block_size
+                    if position + block_size > end:
+                        break
+                    a, b = get_rsum(seed[position:position + block_size])
+                    if check_next and position + 2 * block_size <= end:
+                        a2, b2 = get_rsum(seed[position + block_size:
+                                               position + 2 * block_size])
+                    continue
+            if position + block_size >= end:
+                break
+            removed = seed[position]
+            a = (a - removed + seed[position + block_size]) & 0xffff
+            b = (b - block_size * removed + a) & 0xffff
+            if check_next and position + 2 * block_size < end:
+                removed = seed[position + block_size]
+                a2 = (a2 - removed + seed[position + 2 * block_size]) & 0xffff
+                b2 = (b2 - block_size * removed + a2) & 0xffff
+            next_block = None
+            position += 1
+        self.find_duplicate_blocks(found)
+        return found
+
+    def match_blocks(self, seed, position, candidates, next_rsum,
+                     next_block):
+        zsync = self.zsync
+        if next_rsum is not None:
+            # A weak match also has to be followed by the next block, as
+            # the weak checksums are truncated
+            candidates = [
+                i for i in candidates
+                if i + 1 == zsync.blocks or zsync.rsums[i + 1] == next_rsum]
+            if not candidates:
+                return None
+        # A block continuing a run of verified blocks is taken on its weak
+        # checksum, as the strong one is costly without a native MD4 and
+        # the rebuilt file is verified as a whole anyway
+        if next_block in candidates:
+            return [next_block]
+        checksum = md4(seed[position:position + zsync.block_size])[
+            :zsync.checksum_bytes]
+        return [i for i in candidates if zsync.strong[i] == checksum]
+
+    def find_duplicate_blocks(self, found):
+        # Blocks repeated in the new file are copied from the same place
+        zsync = self.zsync
+        offsets = {
+            (zsync.rsums[i], zsync.strong[i]): offset
+            for i, offset in found.items()}
+        for i in range(zsync.blocks):
+            if i not in found:
+                offset = offsets.get((zsync.rsums[i], zsync.strong[i]))
+                if offset is not None:
+                    found[i] = offset
+
+    def copy_blocks(self, seed, found, f):
+        for i, offset in found.items():
+            f.seek(i * self.zsync.block_size)
+            f.write(seed[offset:offset + self.zsync.get_block_length(i)])
+
+    def get_missing_ranges(self, found):
+        zsync = self.zsync
+        ranges = []
+        for i in range(zsync.blocks):
+            if i in found:
+                continue
+            start = i * zsync.block_size
+            end = start + zsync.get_block_length(i) - 1
+            if ranges and start - ranges[-1][1] <= RANGE_GAP:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    def fetch_blocks(self, url, found, f):
+        pending = self.get_missing_ranges(found)
+        downloaded = 0
+        ranges_per_request = MAX_RANGES_PER_REQUEST
+        while pending:
+            batch = pending[:ranges_per_request]
+            response = self.session.get(url, stream=True, headers={
+                "Range": "bytes=" + ",".join(
+                    "{}-{}".format(start, end) for start, end in batch)})
+            try:
+                if response.status_code == 200 and len(batch) > 1:
+                    # Multiple ranges are not supported, ask for them one
+                    # at a time
+                    ranges_per_request = 1
+                    continue
+                if response.status_code != 206:
+                    raise Exception(
+                        f"Server returned {response.status_code}")
+                received = []
+                for start, end, reader in self.iter_parts(response):
+                    downloaded += copy_stream(
+                        reader, f, start, end, self.bandwidth)
+                    received.append((start, end))
+            finally:
+                response.close()
+            remaining = [
+                block_range for block_range in pending
+                if not any(start <= block_range[0] and block_range[1] <= end
+                           for start, end in received)]
+            if len(remaining) == len(pending):
+                raise Exception("Server returned none of the ranges")
+            pending = remaining
+        return downloaded
+
+    def iter_parts(self, response):
+        reader = io.BufferedReader(response.raw, CHUNK_SIZE)
+        content_type = response.headers.get("content-type", "")
+        if not content_type.startswith("multipart/byteranges"):
+            start, end = parse_content_range(
+                response.headers.get("content-range", ""))
+            yield start, end, reader
+            return
+        match = BOUNDARY_PATTERN.search(content_type)
+        if not match:
+            raise Exception("Missing multipart boundary")
+        delimiter = b"--" + match.group(1).encode()
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            line = line.strip()
+            if not line:
+                continue
+            if line == delimiter + b"--":
+                return
+            if line != delimiter:
+                raise Exception("Malformed multipart response")
+            headers = {}
+            while True:
+                line = reader.readline().strip()
+                if not line:
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            start, end = parse_content_range(
+                headers.get("content-range", ""))
+            yield start, end, reader
+
+    def check_file(self, file_path, sha256=None):
+        actual_sha1 = hashlib.sha1()
+        actual_sha256 = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                actual_sha1.update(chunk)
+                actual_sha256.update(chunk)
+        if self.zsync.sha1 and \
+                actual_sha1.hexdigest() != self.zsync.sha1.lower():
+            raise Exception("SHA-1 of the rebuilt file does not match")
+        if sha256 and actual_sha256.hexdigest() != sha256:
+            raise Exception("SHA-256 of the rebuilt file does not match")
+        return actual_sha256.hexdigest()
+
+
+def parse_content_range(content_range):
+    match = CONTENT_RANGE_PATTERN.match(content_range)
+    if not match:
+        raise Exception(f"Unexpected Content-Range: {content_range}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def copy_stream(reader, f, start, end, bandwidth=None):
+    f.seek(start)
+    remaining = end + 1 - start
+    while remaining:
+        chunk = reader.read(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            raise Exception("Response ended early")
+        f.write(chunk)
+        remaining -= len(chunk)
+        if bandwidth is not None:
+            bandwidth.wait(len(chunk))
+    return end + 1 - start
+
+
+def get_rsum(block):
+    # The weak checksum of zsync, as its two 16-bit halves
+    return sum(block) & 0xffff, sum(accumulate(block)) & 0xffff
+
+
+def md4(data):
+    try:
+        return hashlib.new("md4", data).digest()
+    except ValueError:
+        # Not provided by OpenSSL 3 without the legacy provider
+        return md4_fallback(data)
+
+
+def md4_fallback(data):
+    def rotate(x, n):
+        x &= 0xffffffff
+        return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+    message = bytes(data)
+    length = len(message) * 8
+    message += b"\x80" + b"\x00" * ((55 - len(message)) % 64) + \
+        struct.pack("<Q", length & 0xffffffffffffffff)
+    h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+    for offset in range(0, len(message), 64):
+        x = struct.unpack("<16I", message[offset:offset + 64])
+        a, b, c, d = h
+        for i in range(16):
+            k, s = i, (3, 7, 11, 19)[i % 4]
+            a, b, c, d = d, rotate(a + ((b & c) | (~b & d)) + x[k], s), b, c
+        for i in range(16):
+            k, s = (i % 4) * 4 + i // 4, (3, 5, 9, 13)[i % 4]
+            a, b, c, d = d, rotate(
+                a + ((b & c) | (b & d) | (c & d)) + x[k] + 0x5a827999,
+                s), b, c
+        for i in range(16):
+            k = (0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15)[i]
+            s = (3, 9, 11, 15)[i % 4]
+            a, b, c, d = d, rotate(
+                a + (b ^ c ^ d) + x[k] + 0x6ed9eba1, s), b, c
+        h = [(value + new) & 0xffffffff
+             for value, new in zip(h, (a, b, c, d))]
+    return struct.pack("<4I", *h)
+
+
+def delta_download(*args, **kwargs):
+    return DeltaDownload()(*args, **kwargs)
@@ -1,51 +1,352 @@
 import requests
+import errno
+import hashlib
+import json
 import os
+import re
 import sys
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 
+CHUNK_SIZE = 64 * 1024
+MIN_SEGMENT_SIZE = 1024 * 1024
+# Reads grow up to MAX_CHUNK_SIZE while they complete quickly, so fast links
+# cost few iterations and slow ones still update the progress bar
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+READ_TIME_TARGET = 0.1
+PROGRESS_INTERVAL = 0.2
+# The resume point is recorded in the sidecar after this many bytes, as the
+# preallocated `.part` file no longer tells how much of it was written
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+PART_FILE_SUFFIX = ".part"
+PART_META_FILE_SUFFIX = ".part.json"
+
+
 class FileDownload:
-    def __call__(self, url, file_path):
+    # Bytes actually transferred, over all attempts made with the instance
+    received = 0
+
+    def __call__(self, url, file_path, segments=1, session=None,
+                 length=None, updated_at=None, sha256=None, bandwidth=None):
+        self.segments = segments
+        self.session = session if session is not None else requests
+        self.bandwidth = bandwidth
+        resume = self.prepare(url, file_path, length, updated_at)
+        if segments > 1:
+            actual_sha256 = self.download_segmented(resume)
+        else:
+            actual_sha256 = self.download(resume)
+        return self.finish(actual_sha256, sha256)
+
+    def prepare(self, url, file_path, length=None, updated_at=None):
         self.url = url
         self.file_path = file_path
-        self.download()
+        self.length = length
+        self.updated_at = updated_at
 
-    def download(self):
-        with open(self.file_path, "ab") as f:
-            f.seek(0)
-            f.truncate(0)
-            total_size = None
+        # Data goes to a `.part` file described by a sidecar, so that an
+        # interrupted download can be resumed by a later run and the final
+        # name only ever holds a complete file
+        self.part_path = file_path + PART_FILE_SUFFIX
+        self.meta_path = file_path + PART_META_FILE_SUFFIX
+        self.meta = self.load_meta()
+        resume = self.meta is not None and os.path.isfile(self.part_path)
+        if not resume:
+            self.meta = {
+                "url": url,
+                "length": length,
+                "updated_at": updated_at
+            }
+            self.save_meta()
+        return resume
+
+    def finish(self, actual_sha256, sha256=None):
+        if sha256 and actual_sha256 != sha256:
+            self.discard()
+            raise Exception(
+                f"Checksum mismatch: expected {sha256}, got {actual_sha256}")
+        os.replace(self.part_path, self.file_path)
+        os.remove(self.meta_path)
+        return actual_sha256
+
+    def load_meta(self):
+        # Only resume when the sidecar describes the very same asset
+        if self.length is None or not os.path.isfile(self.meta_path):
+            return None
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except ValueError:
+            return None
+        if meta.get("url") != self.url or \
+                meta.get("length") != self.length or \
+                meta.get("updated_at") != self.updated_at:
+            return None
+        return meta
+
+    def save_meta(self):
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def download(self, resume=False):
+        # The file is written strictly in order, so it is hashed on the fly
+        f, total_size = self.open_part_file(resume)
+        with f:
             while f.tell() != total_size:
                 headers = {}
                 downloaded_bytes = f.tell()
-                if total_size:
+                if downloaded_bytes:
                     headers['Range'] = f'bytes={downloaded_bytes}-'
-                response = requests.get(self.url, headers=headers, stream=True)
-                
-                if response.status_code == 206 and not downloaded_bytes or \
-                        response.status_code == 200 and downloaded_bytes:
-                    if response.status_code == 200:
-                        raise Exception("Range header is not supported")
-                    else:
-                        raise Exception(
-                            f"Server returned {response.status_code}")
-                if total_size is None:
-                    total_size = int(response.headers.get('content-length'))
-                current_total_size = int(response.headers.get('content-length'))
-                if current_total_size + downloaded_bytes != total_size:
-                    raise Exception("Size changed")
-
-                progress_bar = tqdm(
-                    unit="B", unit_scale=True,
-                    total=total_size,
-                    disable=not os.isatty(sys.stderr.fileno()))
-                progress_bar.update(downloaded_bytes)
-
-                for chunk in response.iter_content(1024):
-                    if chunk:
-                        f.write(chunk)
-                        progress_bar.update(len(chunk))
-
-
-file_download = FileDownload()
+                response = self.session.get(
+                    self.url, headers=headers, stream=True)
+                downloaded_bytes, total_size = self.check_response(
+                    f, response.status_code,
+                    int(response.headers.get('content-length')),
+                    downloaded_bytes, total_size)
+                self.preallocate(f, total_size)
+
+                self.progress_bar = self.create_progress_bar(total_size)
+                self.progress_bar.update(downloaded_bytes)
+
+                with self.progress_bar:
+                    try:
+                        for chunk in self.iter_response(response):
+                            self.write_chunk(f, chunk)
+                    finally:
+                        self.checkpoint(f)
+                        self.flush_progress()
+        return self.sha256.hexdigest()
+
+    def open_part_file(self, resume):
+        self.sha256 = hashlib.sha256()
+        self.pending_progress = 0
+        self.last_progress = time.monotonic()
+        if not os.path.isfile(self.part_path):
+            open(self.part_path, "wb").close()
+        f = open(self.part_path, "r+b")
+        if resume:
+            # Sidecars without a resume point come from unallocated files
+            downloaded_bytes = self.meta.get("downloaded")
+            if downloaded_bytes is None:
+                downloaded_bytes = os.path.getsize(self.part_path)
+            f.truncate(min(downloaded_bytes, self.length))
+            f.seek(0, os.SEEK_END)
+            hash_file(self.part_path, self.sha256)
+            self.checkpoint(f)
+            return f, self.length
+        f.truncate(0)
+        self.checkpoint(f)
+        return f, None
+
+    def iter_response(self, response):
+        if response.headers.get("content-encoding", "identity") != "identity":
+            for chunk in response.iter_content(CHUNK_SIZE):
+                yield chunk
+                self.throttle(len(chunk))
+            return
+        # Read straight into one reused buffer instead of a new bytes
+        # object per chunk
+        view = memoryview(bytearray(MAX_CHUNK_SIZE))
+        chunk_size = CHUNK_SIZE
+        while True:
+            read_size = chunk_size
+            if self.bandwidth is not None:
+                read_size = self.bandwidth.get_slice_size(chunk_size)
+            started = time.monotonic()
+            size = response.raw.readinto(view[:read_size])
+            if not size:
+                return
+            yield view[:size]
+            elapsed = time.monotonic() - started
+            if size == chunk_size and elapsed < READ_TIME_TARGET / 2:
+                chunk_size = min(MAX_CHUNK_SIZE, chunk_size * 2)
+            elif elapsed > READ_TIME_TARGET * 2:
+                chunk_size = max(CHUNK_SIZE, chunk_size // 2)
+            self.throttle(size)
+
+    def throttle(self, size):
+        # The wait is left out of the read time, so it does not shrink reads
+        if self.bandwidth is not None:
+            self.bandwidth.wait(size)
+
+    def write_chunk(self, f, chunk):
+        f.write(chunk)
+        self.sha256.update(chunk)
+        self.received += len(chunk)
+        self.pending_progress += len(chunk)
+        if time.monotonic() - self.last_progress >= PROGRESS_INTERVAL:
+            self.flush_progress()
+        if f.tell() - self.meta["downloaded"] >= CHECKPOINT_SIZE:
+            self.checkpoint(f)
+
+    def flush_progress(self):
+        self.progress_bar.update(self.pending_progress)
+        self.pending_progress = 0
+        self.last_progress = time.monotonic()
+
+    def checkpoint(self, f):
+        f.flush()
+        self.meta["downloaded"] = f.tell()
+        self.save_meta()
+
+    def preallocate(self, f, total_size):
+        # Reserving the space up front avoids fragmentation and fails early
+        # if the disk is too small
+        if not total_size or not hasattr(os, "posix_fallocate"):
+            return
+        f.flush()
+        try:
+            os.posix_fallocate(f.fileno(), 0, total_size)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+                raise
+
+    def check_response(self, f, status_code, content_length,
+                       downloaded_bytes, total_size):
+        if status_code == 200 and downloaded_bytes:
+            # Range was ignored, start over with the full content
+            f.seek(0)
+            f.truncate(0)
+            self.checkpoint(f)
+            self.sha256 = hashlib.sha256()
+            downloaded_bytes = 0
+        elif status_code == 206 and not downloaded_bytes or \
+                status_code not in (200, 206):
+            raise Exception(f"Server returned {status_code}")
+        if total_size is None:
+            total_size = content_length
+        if content_length + downloaded_bytes != total_size:
+            raise Exception("Size changed")
+        return downloaded_bytes, total_size
+
+    def download_segmented(self, resume=False):
+        response = None
+        if resume:
+            total_size = self.length
+        else:
+            # The first segment's request doubles as a probe for range support
+            response = self.session.get(
+                self.url, headers={'Range': 'bytes=0-'}, stream=True)
+            content_range = response.headers.get('content-range', '')
+            match = re.match(r'bytes 0-\d+/(\d+)$', content_range)
+            if response.status_code != 206 or not match:
+                response.close()
+                return self.download()
+            total_size = int(match.group(1))
+
+        segments = max(1, min(self.segments, total_size // MIN_SEGMENT_SIZE))
+        segment_size = -(-total_size // segments)
+        ranges = [
+            (start, min(start + segment_size, total_size) - 1)
+            for start in range(0, total_size, segment_size)]
+
+        # Finished segments are recorded in the sidecar as they complete
+        if self.meta.get("segment_size") != segment_size:
+            self.meta["segment_size"] = segment_size
+            self.meta["done"] = []
+            # Nothing is written in order, so a single-stream download
+            # taking over has to start from the beginning
+            self.meta["downloaded"] = 0
+            self.save_meta()
+        done = set(self.meta["done"])
+        ranges = [(start, end) for start, end in ranges if start not in done]
+        if response is not None and ranges[0][0] != 0:
+            response.close()
+            response = None
+
+        self.progress_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.progress_bar = self.create_progress_bar(total_size)
+        self.progress_bar.update(total_size - sum(
+            end + 1 - start for start, end in ranges))
+
+        if not os.path.isfile(self.part_path):
+            open(self.part_path, "wb").close()
+        with open(self.part_path, "r+b") as f, self.progress_bar:
+            f.truncate(total_size)
+            self.preallocate(f, total_size)
+            with ThreadPoolExecutor(max_workers=max(1, len(ranges))) \
+                    as executor:
+                futures = {
+                    executor.submit(
+                        self.download_segment, f, start, end,
+                        response if start == 0 else None): start
+                    for start, end in ranges}
+                for future in as_completed(futures):
+                    future.result()
+                    self.meta["done"].append(futures[future])
+                    self.save_meta()
+
+        # Segments arrive out of order, so hash the completed file instead
+        return hash_file(self.part_path)
+
+    def download_segment(self, f, start, end, response=None):
+        offset = start
+        while offset <= end:
+            if response is None:
+                response = self.session.get(
+                    self.url, headers={'Range': f'bytes={offset}-{end}'},
+                    stream=True)
+                if response.status_code != 206:
+                    response.close()
+                    # Do not resume from this state, so the next attempt
+                    # probes the server again
+                    self.discard()
+                    raise Exception(
+                        f"Server returned {response.status_code} for range")
+            try:
+                for chunk in self.iter_response(response):
+                    chunk = chunk[:end + 1 - offset]
+                    if not chunk:
+                        continue
+                    self.write_at(f, chunk, offset)
+                    offset += len(chunk)
+                    with self.progress_lock:
+                        self.received += len(chunk)
+                        self.progress_bar.update(len(chunk))
+                    if offset > end:
+                        break
+            finally:
+                response.close()
+            response = None
+
+    def create_progress_bar(self, total_size):
+        # Several downloads may run at once, so label each bar with its file
+        return tqdm(
+            unit="B", unit_scale=True,
+            total=total_size,
+            desc=os.path.basename(self.file_path),
+            disable=not os.isatty(sys.stderr.fileno()))
+
+    def write_at(self, f, data, offset):
+        if hasattr(os, "pwrite"):
+            os.pwrite(f.fileno(), data, offset)
+        else:
+            with self.write_lock:
+                f.seek(offset)
+                f.write(data)
+
+
+def hash_file(file_path, sha256=None):
+    if sha256 is None:
+        sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_download(*args, **kwargs):
+    # A fresh instance per call, so that concurrent downloads share no state
+    return FileDownload()(*args, **kwargs)
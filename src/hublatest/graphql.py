@@ -0,0 +1,90 @@
+GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Number of repositories looked up by one query
+GRAPHQL_BATCH_SIZE = 50
+
+RELEASES_PER_QUERY = 10
+ASSETS_PER_QUERY = 100
+
+RELEASE_FIELDS = """
+    tagName
+    isPrerelease
+    isDraft
+    releaseAssets(first: %d) {
+        pageInfo { hasNextPage }
+        nodes { name size updatedAt downloadUrl }
+    }
+""" % ASSETS_PER_QUERY
+
+
+def get_batches(repos):
+    # `repos` maps repo identifiers to `(owner, repo, prerelease)`
+    items = list(repos.items())
+    for start in range(0, len(items), GRAPHQL_BATCH_SIZE):
+        yield dict(items[start:start + GRAPHQL_BATCH_SIZE])
+
+
+def build_query(batch):
+    params = []
+    fields = []
+    variables = {}
+    for i, (owner, repo, prerelease) in enumerate(batch.values()):
+        params.append("$o{0}: String!, $n{0}: String!".format(i))
+        variables["o{}".format(i)] = owner
+        variables["n{}".format(i)] = repo
+        # `latestRelease` is the newest non-prerelease, like
+        # `/releases/latest` of the REST API
+        if prerelease == False:
+            releases = "latestRelease { %s }" % RELEASE_FIELDS
+        else:
+            releases = (
+                "releases(first: %d, orderBy: {field: CREATED_AT, "
+                "direction: DESC}) { nodes { %s } }" % (
+                    RELEASES_PER_QUERY, RELEASE_FIELDS))
+        fields.append("r{0}: repository(owner: $o{0}, name: $n{0}) {{ {1} }}"
+                      .format(i, releases))
+    query = "query ({}) {{ {} }}".format(", ".join(params), " ".join(fields))
+    return query, variables
+
+
+def parse_response(batch, result):
+    # Returns the releases found, in the shape of the REST API's release
+    # objects; repositories left out are to be looked up over REST
+    data = result.get("data") or {}
+    releases = {}
+    for i, (identifier, (owner, repo, prerelease)) in \
+            enumerate(batch.items()):
+        repository = data.get("r{}".format(i))
+        if not repository:
+            continue
+        if prerelease == False:
+            nodes = [repository["latestRelease"]]
+        else:
+            nodes = repository["releases"]["nodes"]
+        for node in nodes:
+            if not node or node["isDraft"]:
+                continue
+            if prerelease is None or node["isPrerelease"] == prerelease:
+                release = to_rest_release(node)
+                if release is not None:
+                    releases[identifier] = release
+                break
+    return releases
+
+
+def to_rest_release(node):
+    assets = node["releaseAssets"]
+    if assets["pageInfo"]["hasNextPage"]:
+        return None
+    return {
+        "tag_name": node["tagName"],
+        "prerelease": node["isPrerelease"],
+        "assets": [
+            {
+                "name": asset["name"],
+                "size": asset["size"],
+                "updated_at": asset["updatedAt"],
+                "browser_download_url": asset["downloadUrl"]
+            }
+            for asset in assets["nodes"]]
+    }
@@ -0,0 +1,80 @@
+import os
+import signal
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
+
+
+# A command containing this variable is run once per release with all the
+# files, instead of once per file
+BATCH_VARIABLE = "{filepaths}"
+
+# Hooks are started in their own process group, so that a timeout also
+# kills what the shell has spawned
+NEW_SESSION = hasattr(os, "killpg")
+
+
+# Runs hooks on a bounded pool of threads each waiting for one process, so
+# that repositories carry on while slow hooks run
+class HookRunner:
+
+    def __init__(self, jobs=1):
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def submit(self, function, *args):
+        return self.executor.submit(function, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def is_batch_command(cmd_template):
+    return BATCH_VARIABLE in cmd_template
+
+
+def run_hook(cmd, logger, timeout=None):
+    # Returns the exit code, or None if the timeout was hit
+    process = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE,
+                    start_new_session=NEW_SESSION)
+    timed_out = threading.Event()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill_hook, [process, timed_out])
+        timer.start()
+    stderr_reader = threading.Thread(
+        target=log_lines, args=(process.stderr, logger.info))
+    stderr_reader.start()
+    try:
+        log_lines(process.stdout, logger.debug)
+        stderr_reader.join()
+        returncode = process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+    return None if timed_out.is_set() else returncode
+
+
+def kill_hook(process, timed_out=None):
+    if timed_out:
+        timed_out.set()
+    try:
+        if NEW_SESSION:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        pass
+
+
+def log_lines(stream, log):
+    with stream:
+        for line in stream:
+            log_line(line, log)
+
+
+def log_line(line, log):
+    line = line.decode(sys.stdout.encoding or "utf-8", "replace").rstrip()
+    if line:
+        log("> " + line)
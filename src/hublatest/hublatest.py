@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 
-import json
 import configparser
-import urllib.request
+import json
 import os
 import sys
 import argparse
@@ -10,11 +9,21 @@ import traceback
 import re
 import logging
 import gettext
+import time
 
-from subprocess import run, PIPE
 from shlex import quote
 from collections import namedtuple
-from .file_download import file_download
+from threading import BoundedSemaphore
+from .bandwidth import BandwidthLimiter, parse_schedule
+from .blobstore import BLOB_STORE_DIR, BlobStore
+from .graphql import (
+    GRAPHQL_BATCH_SIZE, GRAPHQL_URL, build_query, get_batches, parse_response)
+from .metrics import NULL_REPO_METRICS, Metrics
+from .ratelimit import RateLimited, RateLimiter
+from .state import JsonState, SqliteState
+
+# The download stack (requests, tqdm, asyncio, subprocess, thread pools) is
+# imported where it is first used, so that `--check` and `--help` start fast
 
 
 translation = gettext.translation(
@@ -24,85 +33,288 @@ translation = gettext.translation(
 _ = translation.gettext
 
 
-API_URL_TEMPLATE = "https://api.github.com/repos/{0}/{1}/releases"
-VER_FILE_NAME_TEMPLATE_SUBDIR = "{0}/{1}.json"
-VER_FILE_NAME_TEMPLATE_NO_SUBDIR = ".{0}.{1}.json"
+API_URL = "https://api.github.com"
+RELEASES_PATH_TEMPLATE = "/repos/{0}/{1}/releases"
+RELEASES_PER_PAGE = 10
+# Pages searched for a prerelease, rather than the whole history of a
+# repository that has no recent prereleases
+MAX_PRERELEASE_PAGES = 2
+CHECKSUMS_FILE_PATTERN = re.compile(r"^sha256sums?(\.txt)?$", re.IGNORECASE)
+ZSYNC_SUFFIX = ".zsync"
+# Exit code of `--check` when any repository has an update
+EXIT_UPDATES = 100
+# Local files whose names are less similar than this to the name of a new
+# file are not used as its old copy for delta updates
+SEED_NAME_SIMILARITY = 0.6
 
 DEFAULT_OPTIONS = {
+    "api_url": API_URL,
     "version_file_dir": None,
+    "state_db": None,
     "download_dir": ".",
     "use_subdir": False,
+    "blob_store": False,
+    "delta": False,
     "max_retry": 5,
+    "segments": 1,
+    "asset_jobs": 1,
+    "jobs": 1,
+    "max_downloads": 0,
+    "max_rate": None,
+    "hook_jobs": 1,
+    "hook_timeout": 0.0,
+    "pool_size": 10,
+    "timeout": 60.0,
+    "engine": "threads",
+    "token": None,
+    "graphql": False,
+    "graphql_url": GRAPHQL_URL,
+    "daemon": False,
+    "check": False,
+    "min_interval": 300.0,
+    "max_interval": 86400.0,
+    "metrics_file": None,
+    "prometheus_file": None,
+    "prometheus_port": 0,
     "verbose": False
 }
 
 OPTION_TYPES = {
+    "api_url": str,
     "version_file_dir": str,
+    "state_db": str,
     "download_dir": str,
     "use_subdir": bool,
+    "blob_store": bool,
+    "delta": bool,
     "regex_filter": str,
     "prerelease": bool,
     "post_download": str,
     "post_remove": str,
     "force": bool,
+    "verify": bool,
     "max_retry": int,
+    "segments": int,
+    "asset_jobs": int,
+    "jobs": int,
+    "max_downloads": int,
+    "max_rate": str,
+    "hook_jobs": int,
+    "hook_timeout": float,
+    "pool_size": int,
+    "timeout": float,
+    "engine": str,
+    "token": str,
+    "graphql": bool,
+    "graphql_url": str,
+    "daemon": bool,
+    "check": bool,
+    "min_interval": float,
+    "max_interval": float,
+    "metrics_file": str,
+    "prometheus_file": str,
+    "prometheus_port": int,
     "verbose": bool
 }
 
+# Options that apply to the whole run rather than to a single repository
+GLOBAL_OPTIONS = (
+    "jobs", "max_downloads", "hook_jobs", "pool_size", "timeout", "state_db",
+    "engine", "token", "graphql", "graphql_url", "daemon", "check",
+    "min_interval",
+    "max_interval", "metrics_file", "prometheus_file", "prometheus_port",
+    "verbose")
+ENGINES = ("threads", "asyncio")
+
+
+AssetFile = namedtuple("AssetFile", "filename updated_at length sha256")
+AssetFile.__new__.__defaults__ = (None,)
+
+
+def asset_key(file):
+    # The checksum is not part of a file's identity, as it may be unknown
+    return file.filename, file.updated_at, file.length
+
+
+class RepoLoggerAdapter(logging.LoggerAdapter):
+
+    def process(self, msg, kwargs):
+        return "[{}] {}".format(self.extra["repo"], msg), kwargs
+
 
-AssetFile = namedtuple("AssetFile", "filename updated_at length")
+# Mirrors the parts of `requests.Response` used by the release lookup
+class ApiResponse:
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(_("Request failed, returned: {}.").format(
+                self.status_code))
 
 
 class DownloadRepoRelease:
 
-    def __call__(
+    def __call__(self, *args, **kwargs):
+        self.setup(*args, **kwargs)
+        if self.session is None:
+            from .session import Session
+            self.session = Session()
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter()
+
+        with self.metrics.track():
+            changed = self.run()
+            self.metrics.record_result(changed)
+        return changed
+
+    def run(self):
+        os.makedirs(self.download_dir, 0o755, True)
+        with self.metrics.phase("api"):
+            release = self.release or self.get_release()
+        if release is None:
+            self.skip_not_modified()
+            return False
+        self.load_release(release)
+
+        if not self.state:
+            self.logger.debug(
+                _("No --version-file-dir specified, will download only."))
+            with self.metrics.phase("download"):
+                self.download_files()
+            return True
+
+        with self.metrics.phase("check"):
+            self.check_local_files()
+        if self.files_needed:
+            with self.metrics.phase("download"):
+                self.download_files()
+        else:
+            self.logger.info(_("No new releases need to be downloaded."))
+
+        self.find_files_to_remove()
+        if self.files_to_remove:
+            with self.metrics.phase("remove"):
+                self.remove_old_files()
+        self.remove_stale_parts()
+
+        with self.metrics.phase("save"):
+            self.save_state()
+        return self.is_changed()
+
+    def setup(
             self, owner, repo,
+            api_url=DEFAULT_OPTIONS["api_url"],
             version_file_dir=DEFAULT_OPTIONS["version_file_dir"],
             download_dir=DEFAULT_OPTIONS["download_dir"],
             use_subdir=DEFAULT_OPTIONS["use_subdir"],
+            blob_store=DEFAULT_OPTIONS["blob_store"],
+            delta=DEFAULT_OPTIONS["delta"],
             regex_filter=None,
             prerelease=None,
             post_download=None,
             post_remove=None,
+            hook_timeout=DEFAULT_OPTIONS["hook_timeout"],
             force=False,
+            verify=False,
             max_retry=DEFAULT_OPTIONS["max_retry"],
+            segments=DEFAULT_OPTIONS["segments"],
+            asset_jobs=DEFAULT_OPTIONS["asset_jobs"],
+            download_slots=None,
+            max_rate=None,
+            bandwidth=None,
+            hook_runner=None,
+            session=None,
+            rate_limiter=None,
+            token=None,
+            release=None,
+            metrics=None,
+            state=None,
             logger=logging.getLogger("github_release_dl")):
 
         self.owner = owner
         self.repo = repo
+        self.api_url = api_url
         self.version_file_dir = version_file_dir
         self.regex_filter = regex_filter
         self.prerelease = prerelease
         self.post_download = post_download
         self.post_remove = post_remove
+        self.hook_timeout = hook_timeout
+        self.force = force
+        self.verify = verify
+        self.delta = delta
         self.max_retry = max_retry
+        self.segments = segments
+        self.asset_jobs = asset_jobs
+        self.download_slots = download_slots
+        # A rate of the repository is shared by its own downloads, which
+        # also count against the global one
+        self.bandwidth = bandwidth
+        if max_rate:
+            self.bandwidth = BandwidthLimiter(
+                parse_schedule(max_rate), bandwidth)
+        self.hook_runner = hook_runner
+        self.session = session
+        self.rate_limiter = rate_limiter
+        self.token = token
+        self.release = release
+        self.metrics = NULL_REPO_METRICS
+        if metrics is not None:
+            self.metrics = metrics.repo("{}/{}".format(owner, repo))
         self.logger = logger
 
         if use_subdir:
-            ver_file_name_template = VER_FILE_NAME_TEMPLATE_SUBDIR
             self.download_dir = os.path.join(download_dir, owner, repo)
         else:
-            ver_file_name_template = VER_FILE_NAME_TEMPLATE_NO_SUBDIR
             self.download_dir = download_dir
-        os.makedirs(self.download_dir, 0o755, True)
+        self.blob_store = None
+        if blob_store:
+            self.blob_store = BlobStore(
+                os.path.join(download_dir, BLOB_STORE_DIR))
 
-        self.latest_version, self.release_files = self.get_release_files_list()
-        self.files_needed = self.release_files.copy()
-        logger.info(
-            _("Current newest release version: {}").format(self.latest_version))
-        logger.debug(_("Release assets: {}").format(self.release_files))
+        legacy_state = None
+        if version_file_dir:
+            legacy_state = JsonState(version_file_dir, use_subdir)
+        self.state = state if state is not None else legacy_state
+        self.record = {}
+        self.http_cache = None
+        self.hash_index = {}
+        self.hash_index_changed = False
+        self.checksums = None
+        self.local_files = []
+        self.files_to_remove = []
+        if self.state:
+            self.record = self.state.load(owner, repo, legacy_state)
+            if not force and not verify:
+                self.http_cache = self.record.get("http_cache")
 
-        if not version_file_dir:
-            logger.debug(
-                _("No --version-file-dir specified, will download only."))
-            self.download_files()
-            return
+    def skip_not_modified(self):
+        self.metrics.record_cache_hit("http_not_modified")
+        self.logger.info(
+            _("Releases not modified since last check, nothing to do."))
+        self.state.save(self.owner, self.repo, {})
 
-        version_file_name = ver_file_name_template.format(owner, repo)
-        self.version_file_path = os.path.join(version_file_dir,
-                                              version_file_name)
+    def load_release(self, release):
+        if self.release:
+            self.logger.debug(_("Release found by the GraphQL lookup."))
+            self.metrics.record_cache_hit("graphql")
+        self.latest_version, self.release_files = \
+            self.get_release_files_list(release)
+        self.files_needed = self.release_files.copy()
+        self.logger.info(
+            _("Current newest release version: {}").format(self.latest_version))
+        self.logger.debug(_("Release assets: {}").format(self.release_files))
 
-        if force == True:
+    def check_local_files(self):
+        logger = self.logger
+        if self.force == True:
             logger.debug(_("--force specified, ignoring version file."))
             local_files = []
             local_version = ""
@@ -112,11 +324,12 @@ class DownloadRepoRelease:
             logger.debug(_("Local assets: {}").format(local_files))
 
         self.local_version = local_version
-        self.files_to_remove = []
-        need_update_version_file = False
+        self.local_files = local_files
 
+        local_records = {asset_key(file): file for file in local_files}
         for url in list(self.files_needed.keys()):
-            if self.files_needed[url] in local_files:
+            local_file = local_records.get(asset_key(self.files_needed[url]))
+            if local_file:
                 filename = self.files_needed[url].filename
                 filepath = os.path.join(self.download_dir, filename)
                 length = self.files_needed[url].length
@@ -131,65 +344,68 @@ class DownloadRepoRelease:
                     logger.debug(
                         "> " + _("The local copy of {} has wrong length, will "
                                  "be re-downloaded.").format(filename))
+                elif self.verify and \
+                        not self.verify_file(url, local_file, filepath):
+                    logger.debug(
+                        "> " + _("The local copy of {} has wrong checksum, "
+                                 "will be re-downloaded.").format(filename))
                 else:
                     logger.debug(
                         "> " + _("The local copy of {} looks fine, no need to"
                                  " download.").format(filename))
                     del self.files_needed[url]
+                    if not self.release_files[url].sha256:
+                        self.release_files[url] = \
+                            self.release_files[url]._replace(
+                                sha256=local_file.sha256)
 
-        if self.files_needed:
-            self.download_files()
-            need_update_version_file = True
-        else:
-            logger.info(_("No new releases need to be downloaded."))
-
+    def find_files_to_remove(self):
         release_filenames = []
         for file in self.release_files.values():
             release_filenames.append(file.filename)
 
-        for file in local_files:
+        for file in self.local_files:
             if file.filename not in release_filenames:
                 self.files_to_remove.append(file)
-                need_update_version_file = True
 
-        if self.files_to_remove:
-            self.remove_old_files()
-
-        if need_update_version_file:
-            self.update_version_file()
+    def is_changed(self):
+        return bool(self.files_needed or self.files_to_remove)
 
-    def get_release_files_list(self):
-        api_url = API_URL_TEMPLATE.format(self.owner, self.repo)
-        response = self.try_function(urllib.request.urlopen, [api_url])
-        if response.getcode() == 200:
-            releases = json.loads(response.read())
-        else:
-            raise(_("API request failed, returned: {}.").format(
-                response.getcode()))
+    def save_state(self):
+        updates = {}
+        if self.files_needed or self.files_to_remove or \
+                self.hash_index_changed:
+            updates.update(self.get_version_record())
+        if self.http_cache:
+            updates["http_cache"] = self.http_cache
+        self.state.save(self.owner, self.repo, updates)
 
-        release = None
-        for item in releases:
-            if item["prerelease"] == self.prerelease or self.prerelease is None:
-                release = item
-                break
-        if not release:
-            raise Exception(_("No suitable releases found."))
+    def get_release_files_list(self, release):
         if "assets" not in release or not release["assets"]:
             raise Exception(_("No assets in release."))
 
         if self.regex_filter:
             pattern = re.compile(self.regex_filter)
         assets = {}
+        self.checksums_url = None
+        self.zsync_urls = {}
         for asset in release["assets"]:
             url = asset["browser_download_url"]
             filename = asset["name"]
+            if CHECKSUMS_FILE_PATTERN.match(filename):
+                self.checksums_url = url
+            if filename.endswith(ZSYNC_SUFFIX):
+                self.zsync_urls[filename[:-len(ZSYNC_SUFFIX)]] = url
             if self.regex_filter and not pattern.findall(filename):
                 self.logger.debug("> " + _("Excluded {}").format(filename))
                 continue
+            digest = asset.get("digest") or ""
             asset_obj = AssetFile(
                 filename=filename,
                 updated_at=asset["updated_at"],
-                length=asset["size"]
+                length=asset["size"],
+                sha256=digest[len("sha256:"):]
+                if digest.startswith("sha256:") else None
             )
             assets[url] = asset_obj
             self.logger.debug("> " + _("Added {}").format(filename))
@@ -197,81 +413,481 @@ class DownloadRepoRelease:
             raise Exception(_("No files matched the regex filter."))
         return release["tag_name"], assets
 
+    def get_release(self):
+        lookup = self.lookup_release()
+        try:
+            request = next(lookup)
+            while True:
+                request = lookup.send(self.request_api(*request))
+        except StopIteration as e:
+            return e.value
+
+    def lookup_release(self):
+        # Yields `(url, first)` API requests and is sent back the responses,
+        # so the lookup logic is shared with the asyncio engine
+        releases_url = self.api_url.rstrip("/") + \
+            RELEASES_PATH_TEMPLATE.format(self.owner, self.repo)
+
+        # `/releases/latest` is the newest non-prerelease, so only one small
+        # object has to be fetched
+        if self.prerelease == False:
+            response = yield releases_url + "/latest", True
+            if response.status_code == 304:
+                return None
+            if response.status_code == 404:
+                raise Exception(_("No suitable releases found."))
+            release = response.json()
+            self.cache_release(releases_url + "/latest", response, release)
+            return release
+
+        # Otherwise walk through small pages and stop at the first match
+        per_page = 1 if self.prerelease is None else RELEASES_PER_PAGE
+        page = 1
+        while True:
+            page_url = "{}?per_page={}&page={}".format(
+                releases_url, per_page, page)
+            response = yield page_url, page == 1
+            if response.status_code == 304:
+                return None
+            if response.status_code == 404:
+                raise Exception(_("Repository not found."))
+            releases = response.json()
+            if page == 1:
+                first_url, first_response = page_url, response
+            for item in releases:
+                if self.prerelease is None or \
+                        item["prerelease"] == self.prerelease:
+                    self.cache_release(first_url, first_response, item)
+                    return item
+            if len(releases) < per_page or page == MAX_PRERELEASE_PAGES:
+                raise Exception(_("No suitable releases found."))
+            page += 1
+
+    def request_api(self, url, first=False):
+        return self.try_function(
+            self.get_api_response, [url, self.get_api_headers(url, first)])
+
+    def get_api_headers(self, url, first=False):
+        # Only the first request of a lookup is made conditional, as it
+        # reflects any newly published release
+        headers = self.get_conditional_headers(url) if first else {}
+        if self.token:
+            headers["Authorization"] = "token " + self.token
+        return headers
+
+    def get_api_response(self, url, headers):
+        time.sleep(self.rate_limiter.reserve())
+        response = self.session.get(url, headers=headers)
+        delay = self.rate_limiter.update(
+            response.status_code, response.headers)
+        if delay is not None:
+            raise RateLimited(delay)
+        if response.status_code not in (200, 304, 404):
+            raise Exception(_("API request failed, returned: {}.").format(
+                response.status_code))
+        return response
+
+    def cache_release(self, url, response, release):
+        self.http_cache = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "regex_filter": self.regex_filter,
+            "prerelease": self.prerelease,
+            "release": release
+        }
+
+    def get_conditional_headers(self, api_url):
+        headers = {}
+        cache = self.http_cache
+        if not cache or cache["url"] != api_url or \
+                cache["regex_filter"] != self.regex_filter or \
+                cache["prerelease"] != self.prerelease:
+            return headers
+        if cache["etag"]:
+            headers["If-None-Match"] = cache["etag"]
+        if cache["last_modified"]:
+            headers["If-Modified-Since"] = cache["last_modified"]
+        return headers
+
     def get_local_files_list(self):
-        local_version = None
+        local_version = self.record.get("version")
         current_files = []
-        if os.path.isfile(self.version_file_path):
-            with open(self.version_file_path) as ver_file:
-                local_version_json = json.load(ver_file)
-            local_version = local_version_json["version"]
-            for file in local_version_json["files"]:
-                current_files.append(AssetFile(**file))
+        for file in self.record.get("files", []):
+            current_files.append(AssetFile(**file))
+        self.hash_index = self.record.get("hash_index", {})
         return local_version, current_files
 
+    def get_checksums(self):
+        # Checksums published as a `SHA256SUMS` release asset, if any
+        if self.checksums is None:
+            self.checksums = {}
+            if self.checksums_url:
+                response = self.try_function(
+                    self.session.get, [self.checksums_url])
+                self.checksums = parse_checksums(response.text)
+        return self.checksums
+
+    def get_expected_hash(self, file):
+        return file.sha256 or self.get_checksums().get(file.filename)
+
+    def get_file_hash(self, filepath):
+        # Reuse the hash recorded for the file while its size and mtime
+        # are unchanged
+        filename = os.path.basename(filepath)
+        stat = os.stat(filepath)
+        entry = self.hash_index.get(filename)
+        if entry and entry["size"] == stat.st_size and \
+                entry["mtime"] == stat.st_mtime_ns:
+            self.metrics.record_cache_hit("hash_index")
+            return entry["sha256"]
+        from .file_download import hash_file
+        self.logger.debug(_("Computing checksum of {}").format(filepath))
+        sha256 = hash_file(filepath)
+        self.update_hash_index(filepath, sha256)
+        return sha256
+
+    def update_hash_index(self, filepath, sha256):
+        stat = os.stat(filepath)
+        self.hash_index[os.path.basename(filepath)] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": sha256
+        }
+        self.hash_index_changed = True
+
+    def verify_file(self, url, local_file, filepath):
+        expected_hash = \
+            self.get_expected_hash(self.release_files[url]) or \
+            local_file.sha256
+        if not expected_hash:
+            self.logger.debug(
+                "> " + _("No checksum known for {}, skipping "
+                         "verification.").format(local_file.filename))
+            return True
+        return self.get_file_hash(filepath) == expected_hash
+
     def download_files(self):
-        for url, file in self.files_needed.items():
-            self.logger.info(_("Downloading: {}").format(url))
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        downloaded_files = []
+        if self.asset_jobs == 1:
+            # Run in this thread, so that Ctrl-C stops it right away
+            for url, file in self.files_needed.items():
+                self.finish_download(
+                    url, self.download_file(
+                        url, file, self.get_expected_hash(file)),
+                    downloaded_files)
+        else:
+            with ThreadPoolExecutor(max_workers=self.asset_jobs) as executor:
+                futures = {
+                    executor.submit(self.download_file, url, file,
+                                    self.get_expected_hash(file)): url
+                    for url, file in self.files_needed.items()}
+                try:
+                    for future in as_completed(futures):
+                        self.finish_download(futures[future],
+                                             future.result(),
+                                             downloaded_files)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        self.finish_downloads(downloaded_files)
+
+    def finish_download(self, url, sha256, downloaded_files):
+        # Hooks run as files complete, while the remaining downloads carry on
+        from .hooks import is_batch_command
+        file = self.record_download(url, sha256)
+        downloaded_files.append(file)
+        if self.post_download and not is_batch_command(self.post_download):
+            self.exec_commands(self.post_download, [file])
+
+    def finish_downloads(self, downloaded_files):
+        from .hooks import is_batch_command
+        if self.post_download and is_batch_command(self.post_download):
+            self.exec_commands(self.post_download, downloaded_files)
+
+    def record_download(self, url, sha256):
+        file = self.release_files[url]._replace(sha256=sha256)
+        self.release_files[url] = file
+        self.update_hash_index(
+            os.path.join(self.download_dir, file.filename), sha256)
+        return file
+
+    def download_file(self, url, file, expected_hash):
+        if self.link_stored_file(file, expected_hash):
+            return expected_hash
+        if self.download_slots:
+            self.download_slots.acquire()
+        try:
             file_path = os.path.join(self.download_dir, file.filename)
-            self.try_function(file_download, [url, file_path])
-            if self.post_download:
-                self.exec_commands(self.post_download, file)
+            sha256 = None
+            if self.delta:
+                sha256 = self.download_delta(
+                    url, file, file_path, expected_hash)
+            if sha256 is None:
+                from .file_download import FileDownload
+                self.logger.info(_("Downloading: {}").format(url))
+                started = time.monotonic()
+                download = FileDownload()
+                sha256 = self.try_function(
+                    download,
+                    [url, file_path, self.segments, self.session,
+                     file.length, file.updated_at, expected_hash,
+                     self.bandwidth])
+                self.metrics.record_asset(
+                    file.filename, download.received,
+                    time.monotonic() - started)
+        finally:
+            if self.download_slots:
+                self.download_slots.release()
+        self.store_file(file_path, sha256)
+        return sha256
+
+    def download_delta(self, url, file, file_path, expected_hash):
+        # Returns the SHA-256 of the file rebuilt from an old copy, or None
+        # if it has to be downloaded in full
+        zsync_url = self.zsync_urls.get(file.filename)
+        seed_path = self.find_seed_file(file)
+        if not zsync_url or not seed_path:
+            return None
+        self.logger.info(_("Updating {} from {} with {}").format(
+            file.filename, seed_path, zsync_url))
+        from .delta import delta_download
+        started = time.monotonic()
+        try:
+            response = self.try_function(self.session.get, [zsync_url])
+            response.raise_for_status()
+            result = delta_download(url, file_path, seed_path,
+                                    response.content, self.session,
+                                    expected_hash, self.bandwidth)
+        except Exception as e:
+            self.logger.warning(
+                _("Delta update of {} failed, downloading the whole file: "
+                  "{}").format(file.filename, e))
+            self.logger.debug(traceback.format_exc())
+            return None
+        if result is None:
+            self.logger.info(
+                _("{} has too little in common with the new file.").format(
+                    seed_path))
+            return None
+        sha256, downloaded = result
+        self.metrics.record_asset(
+            file.filename, downloaded, time.monotonic() - started)
+        self.metrics.record_cache_hit("delta")
+        self.logger.info(
+            _("Rebuilt {}, downloaded {} of {} bytes.").format(
+                file.filename, downloaded, file.length))
+        return sha256
+
+    def find_seed_file(self, file):
+        # The old copy is the file of the same name, or else the local file
+        # with the most similar name
+        from difflib import SequenceMatcher
+        candidates = [file.filename] + sorted(
+            (local_file.filename for local_file in self.local_files
+             if local_file.filename != file.filename),
+            key=lambda filename: SequenceMatcher(
+                None, filename, file.filename).ratio(),
+            reverse=True)
+        for filename in candidates:
+            if SequenceMatcher(None, filename, file.filename).ratio() < \
+                    SEED_NAME_SIMILARITY:
+                break
+            seed_path = os.path.join(self.download_dir, filename)
+            if os.path.isfile(seed_path):
+                return seed_path
+        return None
+
+    def link_stored_file(self, file, expected_hash):
+        if not self.blob_store or not expected_hash:
+            return False
+        file_path = os.path.join(self.download_dir, file.filename)
+        try:
+            if not self.blob_store.link(expected_hash, file_path):
+                return False
+        except OSError as e:
+            self.logger.warning(
+                _("Failed to link {} from the blob store: {}").format(
+                    file.filename, e))
+            return False
+        self.logger.info(
+            _("Linked {} from the blob store, no need to download.").format(
+                file.filename))
+        self.metrics.record_cache_hit("blob_store")
+        return True
+
+    def store_file(self, file_path, sha256):
+        if not self.blob_store:
+            return
+        try:
+            self.blob_store.add(file_path, sha256)
+        except OSError as e:
+            self.logger.warning(
+                _("Failed to add {} to the blob store: {}").format(
+                    file_path, e))
 
     def remove_old_files(self):
+        self.finish_removals(self.delete_old_files())
+
+    def delete_old_files(self):
+        removed_files = []
         for file in self.files_to_remove:
             file_pathname = os.path.join(self.download_dir, file.filename)
             self.logger.info(_("Removing old file: {}").format(file_pathname))
             if os.path.isfile(file_pathname):
                 os.remove(file_pathname)
-                if self.post_remove:
-                    self.exec_commands(self.post_remove, file, is_remove=True)
+                removed_files.append(file)
             else:
                 self.logger.warning(
                     _("Old file not found: {}").format(file_pathname))
+        return removed_files
+
+    def finish_removals(self, removed_files):
+        from .hooks import is_batch_command
+        if not self.post_remove or not removed_files:
+            return
+        if is_batch_command(self.post_remove):
+            self.exec_commands(self.post_remove, removed_files,
+                               is_remove=True)
+            return
+        for file in removed_files:
+            self.exec_commands(self.post_remove, [file], is_remove=True)
+
+    def remove_stale_parts(self):
+        # Partial downloads of assets no longer wanted are never resumed.
+        # The assets of a repository share their URL up to the tag, which
+        # tells its sidecars apart from those of other repositories
+        # downloading to the same directory
+        from .file_download import PART_FILE_SUFFIX, PART_META_FILE_SUFFIX
+        prefixes = {url.rsplit("/", 2)[0] for url in self.release_files}
+        try:
+            filenames = os.listdir(self.download_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            if not filename.endswith(PART_META_FILE_SUFFIX):
+                continue
+            meta_path = os.path.join(self.download_dir, filename)
+            try:
+                with open(meta_path) as f:
+                    url = json.load(f).get("url")
+            except (OSError, ValueError, AttributeError):
+                continue
+            if not isinstance(url, str) or url in self.release_files or \
+                    url.rsplit("/", 2)[0] not in prefixes:
+                continue
+            part_path = \
+                meta_path[:-len(PART_META_FILE_SUFFIX)] + PART_FILE_SUFFIX
+            self.logger.info(
+                _("Removing stale partial download: {}").format(part_path))
+            for path in (part_path, meta_path):
+                if os.path.isfile(path):
+                    os.remove(path)
 
-    def update_version_file(self):
-        os.makedirs(os.path.dirname(self.version_file_path), 0o755, True)
+    def get_version_record(self):
         files = self.release_files.values()
         files_output = []
         for f in files:
             files_output.append(f._asdict())
-        with open(self.version_file_path, "w") as ver_file:
-            ver_file_data = {
-                "version": self.latest_version,
-                "files": files_output}
-            json.dump(ver_file_data, ver_file)
+        filenames = [f.filename for f in files]
+        hash_index = {
+            filename: entry for filename, entry in self.hash_index.items()
+            if filename in filenames}
+        return {
+            "version": self.latest_version,
+            "files": files_output,
+            "hash_index": hash_index}
 
     def try_function(self, function, params):
-        for i in range(self.max_retry):
+        attempt = 0
+        while True:
             try:
                 return function(*params)
             except Exception as e:
-                self.logger.warning(
-                    _("Error occured: {}. Retrying.").format(e))
-                if i == self.max_retry - 1:
-                    self.logger.error(
-                        _("Max retry attemps reached. ({} times).").format(
-                            self.max_retry))
-                    raise e
-
-    def exec_commands(self, cmd_template, file, is_remove=False):
-        cmd = cmd_template.format(
-            filename=quote(file.filename),
+                time.sleep(self.get_retry_delay(e, attempt))
+                if not isinstance(e, RateLimited):
+                    attempt += 1
+
+    def get_retry_delay(self, e, attempt):
+        # Waiting for the rate limit to reset does not count as a retry
+        if isinstance(e, RateLimited):
+            self.logger.warning(
+                _("API rate limit reached, waiting {:.0f} seconds.").format(
+                    e.delay))
+            self.metrics.record_rate_limit_wait(e.delay)
+            return e.delay
+        if attempt == self.max_retry - 1:
+            self.logger.error(
+                _("Max retry attemps reached. ({} times).").format(
+                    self.max_retry))
+            raise e
+        delay = self.rate_limiter.backoff(attempt)
+        self.metrics.record_retry()
+        self.logger.warning(
+            _("Error occured: {}. Retrying in {:.1f} seconds.").format(
+                e, delay))
+        return delay
+
+    def format_command(self, cmd_template, files, is_remove=False):
+        filepaths = " ".join(
+            quote(os.path.join(self.download_dir, file.filename))
+            for file in files)
+        return cmd_template.format(
+            filename=" ".join(quote(file.filename) for file in files),
             filedir=quote(self.download_dir),
-            filepath=quote(os.path.join(self.download_dir, file.filename)),
+            filepath=filepaths,
+            filepaths=filepaths,
             owner=quote(self.owner),
             repo=quote(self.repo),
             version=quote(self.local_version if is_remove else
                           self.latest_version))
+
+    def exec_commands(self, cmd_template, files, is_remove=False):
+        cmd = self.format_command(cmd_template, files, is_remove)
         self.logger.debug(_("Executing command: {}").format(cmd))
-        result = run(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        if result.returncode != 0:
+        # Taken now, so that a hook still running in the background when the
+        # next check starts is counted towards this one
+        phase = self.metrics.phase("hooks")
+        if self.hook_runner:
+            self.hook_runner.submit(self.run_command, cmd, phase)
+        else:
+            self.run_command(cmd, phase)
+
+    def run_command(self, cmd, phase):
+        from .hooks import run_hook
+        with phase:
+            try:
+                returncode = run_hook(cmd, self.logger, self.hook_timeout)
+            except OSError as e:
+                self.logger.error(
+                    _("Failed to execute command `{0}`: {1}").format(cmd, e))
+                return
+        self.log_command_result(cmd, returncode)
+
+    def log_command_result(self, cmd, returncode):
+        if returncode is None:
             self.logger.error(
-                _("Command `{0}` returned {1}.").format(cmd, result.returncode))
-            self.logger.error(result.stderr.decode(sys.stdout.encoding))
-            self.logger.debug(result.stdout.decode(sys.stdout.encoding))
+                _("Command `{0}` timed out after {1} seconds.").format(
+                    cmd, self.hook_timeout))
+        elif returncode != 0:
+            self.logger.error(
+                _("Command `{0}` returned {1}.").format(cmd, returncode))
+
 
+def parse_checksums(text):
+    checksums = {}
+    for line in text.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2 and re.match(r"^[0-9a-fA-F]{64}$", fields[0]):
+            filename = os.path.basename(fields[1].strip().lstrip("*"))
+            checksums[filename] = fields[0].lower()
+    return checksums
 
-download_repo_release = DownloadRepoRelease()
+
+def download_repo_release(*args, **kwargs):
+    return DownloadRepoRelease()(*args, **kwargs)
 
 
 def get_arg_parser(no_additional_help=False):
@@ -284,7 +900,10 @@ def get_arg_parser(no_additional_help=False):
         _("Variables can be inserted: `{filename}`, `{filedir}`, `{filepath}`, "
           "`{owner}`, `{repo}`, `{version}`; meaning filename, containing "
           "directory of the file, file path, repo owner, repo name, current "
-          "version; all paths are relative to the work directory")
+          "version; all paths are relative to the work directory") + \
+        "\n&#9;- " + \
+        _("If `{filepaths}` is used, the command is executed once per "
+          "release with the paths of all its files")
 
     if no_additional_help:
         prerel_desp = cmd_desp = ""
@@ -307,55 +926,371 @@ def get_arg_parser(no_additional_help=False):
     parser.add_argument("--post-remove", metavar="COMMAND",
                         help=_("Command to be executed after each file is "
                                "removed") + cmd_desp)
+    parser.add_argument("--hook-jobs", metavar="N", type=int,
+                        help=_("Number of commands run in the background at "
+                               "the same time, while the other repositories "
+                               "are processed (default: {})").format(
+                            DEFAULT_OPTIONS["hook_jobs"]))
+    parser.add_argument("--hook-timeout", metavar="SECONDS", type=float,
+                        help=_("Kill commands that run longer than this "
+                               "(default: no limit)"))
     parser.add_argument("-c", "--config", metavar="PATH",
                         help=_("Path to the config file"))
     parser.add_argument("-v", "--version-file-dir", metavar="PATH",
                         help=_("Directory to put version files (if not "
                                "specified, version files will not be used)"))
+    parser.add_argument("--state-db", metavar="PATH",
+                        help=_("Keep the versions of all repositories in this "
+                               "SQLite database instead of version files "
+                               "(existing version files are migrated)"))
+    parser.add_argument("--api-url", metavar="URL",
+                        help=_("Base URL of the GitHub API (default: {})"
+                               ).format(DEFAULT_OPTIONS["api_url"]))
     parser.add_argument("-d", "--download-dir", metavar="PATH",
                         help=_("Directory to put downloaded files (Default is "
                                "current working directory)"))
     parser.add_argument("--use-subdir", action="store_true",
                         help=_("Save files to sub-directories like "
                                "`owner/repo` (no sub-directories by default)"))
+    parser.add_argument("--blob-store", action="store_true", default=None,
+                        help=_("Keep each distinct file once in `{}` under "
+                               "the download directory and hard-link it "
+                               "into place, so identical assets of other "
+                               "repositories or releases are not downloaded "
+                               "again (downloaded files must not be modified "
+                               "in place)").format(BLOB_STORE_DIR))
+    parser.add_argument("--delta", action="store_true", default=None,
+                        help=_("If a release provides a `.zsync` file for an "
+                               "asset, download only the parts that changed "
+                               "and rebuild it from the old copy (falls back "
+                               "to a full download otherwise; threads engine "
+                               "only)"))
     parser.add_argument("-f", "--force", action="store_true",
                         help=_("Ignore current version file(s) and forcibly "
                                "execute"))
+    parser.add_argument("--verify", action="store_true", default=None,
+                        help=_("Verify the SHA-256 checksums of existing files "
+                               "and re-download mismatched ones (checksums "
+                               "of unchanged files are cached)"))
     parser.add_argument("--max-retry", metavar="N", type=int,
                         help=_("Max retry attemps (default: {})").format(
                             DEFAULT_OPTIONS['max_retry']))
+    parser.add_argument("--segments", metavar="N", type=int,
+                        help=_("Download each file over N parallel connections "
+                               "using byte ranges, falling back to a single "
+                               "connection if the server does not support it "
+                               "(default: {})").format(
+                            DEFAULT_OPTIONS["segments"]))
+    parser.add_argument("--asset-jobs", metavar="N", type=int,
+                        help=_("Number of files of a release to download in "
+                               "parallel (default: {})").format(
+                            DEFAULT_OPTIONS["asset_jobs"]))
+    parser.add_argument("-j", "--jobs", metavar="N", type=int,
+                        help=_("Number of repositories to process in parallel "
+                               "(default: {})").format(DEFAULT_OPTIONS["jobs"]))
+    parser.add_argument("--max-downloads", metavar="N", type=int,
+                        help=_("Max number of files downloaded at the same "
+                               "time across all repositories (default: "
+                               "unlimited)"))
+    parser.add_argument("--max-rate", metavar="RATE",
+                        help=_("Max bytes per second downloaded across all "
+                               "repositories, shared fairly by the running "
+                               "downloads, with an optional K, M or G suffix "
+                               "(e.g. `50M`); may also be a schedule of "
+                               "`HH:MM,RATE` entries like `08:00,5M "
+                               "19:00,off`, each applying until the next one "
+                               "(also settable per repository in the config "
+                               "file) (default: unlimited)"))
+    parser.add_argument("--pool-size", metavar="N", type=int,
+                        help=_("Max number of kept-alive connections per host "
+                               "(default: {})").format(
+                            DEFAULT_OPTIONS["pool_size"]))
+    parser.add_argument("--timeout", metavar="SECONDS", type=float,
+                        help=_("Network timeout in seconds (default: {})"
+                               ).format(DEFAULT_OPTIONS["timeout"]))
+    parser.add_argument("--engine", choices=ENGINES,
+                        help=_("Run on a thread pool or on an asyncio event "
+                               "loop (requires aiohttp) (default: {})").format(
+                            DEFAULT_OPTIONS["engine"]))
+    parser.add_argument("--graphql", action="store_true", default=None,
+                        help=_("Look up the releases of up to {} repositories "
+                               "with a single GraphQL query instead of one "
+                               "REST request per repository (requires a "
+                               "token)").format(GRAPHQL_BATCH_SIZE))
+    parser.add_argument("--graphql-url", metavar="URL",
+                        help=_("GraphQL endpoint (default: {})").format(
+                            DEFAULT_OPTIONS["graphql_url"]))
+    parser.add_argument("--daemon", action="store_true", default=None,
+                        help=_("Keep running and check each repository "
+                               "again after an interval that adapts to how "
+                               "often it publishes releases (send SIGHUP to "
+                               "reload the config file)"))
+    parser.add_argument("--check", action="store_true", default=None,
+                        help=_("Only check which repositories have updates "
+                               "and print them as JSON, without downloading "
+                               "(exit code: 0 if there are none, {} if there "
+                               "are any, 255 on errors)").format(EXIT_UPDATES))
+    parser.add_argument("--min-interval", metavar="SECONDS", type=float,
+                        help=_("Shortest interval between checks of a "
+                               "repository in daemon mode (default: {})"
+                               ).format(DEFAULT_OPTIONS["min_interval"]))
+    parser.add_argument("--max-interval", metavar="SECONDS", type=float,
+                        help=_("Longest interval between checks of a "
+                               "repository in daemon mode (default: {})"
+                               ).format(DEFAULT_OPTIONS["max_interval"]))
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help=_("Write a JSON summary of the time spent in "
+                               "each phase, the files and bytes downloaded, "
+                               "retries and cache hits to this file"))
+    parser.add_argument("--prometheus-file", metavar="PATH",
+                        help=_("Write the metrics in the Prometheus text "
+                               "format to this file, e.g. for the textfile "
+                               "collector of the node exporter"))
+    parser.add_argument("--prometheus-port", metavar="PORT", type=int,
+                        help=_("Serve the metrics in the Prometheus text "
+                               "format at `/metrics` on this port (daemon "
+                               "mode only)"))
     parser.add_argument("--verbose", action="store_true",
                         help=_("Show debug output"))
     return parser
 
 
-def main():
-    parser = get_arg_parser(no_additional_help=True)
-    parsed_args = vars(parser.parse_args())
+def get_repo_arguments(repo_identifier, options, repo_options):
+    repo_options_merged = options.copy()
+    repo_options_merged.update(repo_options)
+    for key in GLOBAL_OPTIONS:
+        repo_options_merged.pop(key, None)
+    # The global rate is shared by all repositories rather than given to
+    # each of them
+    repo_options_merged["max_rate"] = repo_options.get("max_rate")
+    splited_identifier = repo_identifier.split("/")
+    if len(splited_identifier) != 2:
+        raise Exception(
+            _("Repo identifier must be in format of `repo/owner` "
+              "(Erroneous input: {})").format(repo_identifier))
+    owner, repo = splited_identifier
+    return dict(owner=owner, repo=repo, **repo_options_merged)
+
+
+def process_repository(repo_identifier, options, repo_options, **kwargs):
+    logger = RepoLoggerAdapter(logging.getLogger(), {"repo": repo_identifier})
+    logger.info(_("Processing: {}").format(repo_identifier))
+    try:
+        download_repo_release(
+            logger=logger,
+            **get_repo_arguments(repo_identifier, options, repo_options),
+            **kwargs
+        )
+    except Exception as e:
+        logger.warning(_("Error occurred: {}").format(e))
+        logger.debug(traceback.format_exc())
+        return -1
+    return 0
+
+
+def get_lookup_repos(repositories, options):
+    repos = {}
+    for repo_identifier, repo_options in repositories.items():
+        try:
+            arguments = get_repo_arguments(
+                repo_identifier, options, repo_options)
+        except Exception:
+            continue
+        repos[repo_identifier] = (
+            arguments["owner"], arguments["repo"], arguments.get("prerelease"))
+    return repos
+
+
+def iter_release_lookups(repositories, options):
+    # Yields GraphQL queries and is sent back the responses, or the errors
+    # the requests failed with, so the lookup is shared with the asyncio
+    # engine. Repositories whose release is not found here are looked up
+    # over REST.
+    releases = {}
+    repos = get_lookup_repos(repositories, options)
+    for batch in get_batches(repos):
+        query, variables = build_query(batch)
+        result = yield {"query": query, "variables": variables}
+        try:
+            if isinstance(result, Exception):
+                raise result
+            releases.update(parse_response(batch, result))
+        except Exception as e:
+            logging.warning(
+                _("GraphQL lookup failed, falling back to the REST API: {}"
+                  ).format(e))
+    logging.debug(
+        _("Releases of {} of {} repositories found with GraphQL.").format(
+            len(releases), len(repos)))
+    return releases
+
+
+def lookup_releases(repositories, options, session, graphql_url, token,
+                    rate_limiter):
+    lookup = iter_release_lookups(repositories, options)
+    try:
+        query = next(lookup)
+        while True:
+            try:
+                result = post_query(
+                    query, session, graphql_url, token, rate_limiter)
+            except Exception as e:
+                result = e
+            query = lookup.send(result)
+    except StopIteration as e:
+        return e.value
+
+
+def post_query(query, session, graphql_url, token, rate_limiter):
+    time.sleep(rate_limiter.reserve())
+    response = session.post(
+        graphql_url, json=query, headers={"Authorization": "bearer " + token})
+    rate_limiter.update(response.status_code, response.headers)
+    response.raise_for_status()
+    return response.json()
+
+
+def run_repositories(repositories, options, jobs, max_downloads, bandwidth,
+                     hook_jobs, pool_size, timeout, token, graphql,
+                     graphql_url, state, metrics=None):
+    from concurrent.futures import ThreadPoolExecutor
+    from .hooks import HookRunner
+    from .session import Session
+    download_slots = \
+        BoundedSemaphore(max_downloads) if max_downloads > 0 else None
+    hook_runner = HookRunner(hook_jobs)
+    session = Session(pool_size=pool_size, timeout=timeout)
+    rate_limiter = RateLimiter()
+    releases = {}
+    if graphql:
+        # The GraphQL API has a rate limit of its own, apart from the REST
+        # API that the downloads use
+        releases = lookup_releases(repositories, options, session,
+                                   graphql_url, token, RateLimiter())
+
+    kwargs = {
+        "download_slots": download_slots,
+        "bandwidth": bandwidth,
+        "hook_runner": hook_runner,
+        "session": session,
+        "rate_limiter": rate_limiter,
+        "token": token,
+        "metrics": metrics,
+        "state": state
+    }
+    ret_code = 0
+    if jobs == 1:
+        # Run in this thread, so that Ctrl-C stops the sweep right away
+        for repo_identifier, repo_options in repositories.items():
+            if process_repository(repo_identifier, options, repo_options,
+                                  release=releases.get(repo_identifier),
+                                  **kwargs) != 0:
+                ret_code = -1
+        hook_runner.shutdown()
+        return ret_code
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(process_repository, repo_identifier, options,
+                            repo_options,
+                            release=releases.get(repo_identifier), **kwargs)
+            for repo_identifier, repo_options in repositories.items()]
+        try:
+            for future in futures:
+                if future.result() != 0:
+                    ret_code = -1
+        except KeyboardInterrupt:
+            # Only the repositories already running are waited for
+            for future in futures:
+                future.cancel()
+            raise
+    hook_runner.shutdown()
+    return ret_code
+
+
+def load_config(config_path, parsed_args):
     conf = configparser.ConfigParser()
 
-    options = DEFAULT_OPTIONS
+    options = DEFAULT_OPTIONS.copy()
 
     parsed_conf = {}
-    if parsed_args["config"] is not None:
-        conf.read(parsed_args["config"])
+    if config_path is not None:
+        conf.read(config_path)
         for conf_section in conf:
             parsed_conf[conf_section] = {}
             for key, val in conf[conf_section].items():
+                # configparser copies the keys of [DEFAULT] into every
+                # section, but only a rate set by the section itself is its
+                # own; the one of [DEFAULT] is the shared global rate
+                if key == "max_rate" and \
+                        conf_section != conf.default_section and \
+                        val == conf.defaults().get(key):
+                    continue
                 if key in OPTION_TYPES:
                     if OPTION_TYPES[key] == str:
                         parsed_conf[conf_section][key] = val
                     elif OPTION_TYPES[key] == int:
                         parsed_conf[conf_section][key] = int(val)
+                    elif OPTION_TYPES[key] == float:
+                        parsed_conf[conf_section][key] = float(val)
                     elif OPTION_TYPES[key] == bool:
                         parsed_conf[conf_section][key] = \
                             conf.getboolean(conf_section, key)
                 else:
-                    logging.error(_("Unknown config option: {}").format(key))
-                    return -1
+                    raise Exception(
+                        _("Unknown config option: {}").format(key))
         options.update(parsed_conf["DEFAULT"])
         del parsed_conf["DEFAULT"]
-    del parsed_args["config"]
+
+    if parsed_args["repo"]:
+        repositories = {
+            parsed_args["repo"]: {}
+        }
+    else:
+        repositories = parsed_conf
+
+    for key, val in parsed_args.items():
+        if val is not None and key != "repo":
+            options[key] = val
+
+    return options, repositories
+
+
+def collect_garbage(repositories, options):
+    # Blobs no longer linked from any download directory are removed
+    roots = set()
+    for repo_options in repositories.values():
+        repo_options_merged = dict(options, **repo_options)
+        if repo_options_merged["blob_store"]:
+            roots.add(os.path.join(
+                repo_options_merged["download_dir"], BLOB_STORE_DIR))
+    for root in roots:
+        try:
+            removed, freed = BlobStore(root).collect_garbage()
+        except OSError as e:
+            logging.warning(
+                _("Failed to clean up the blob store {}: {}").format(root, e))
+            continue
+        if removed:
+            logging.info(
+                _("Removed {} unused files ({} bytes) from the blob store "
+                  "{}.").format(removed, freed, root))
+
+
+def write_metrics(metrics, metrics_file=None, prometheus_file=None):
+    try:
+        if metrics_file:
+            metrics.write_json(metrics_file)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+    except OSError as e:
+        logging.error(_("Failed to write metrics: {}").format(e))
+
+
+def main():
+    parser = get_arg_parser(no_additional_help=True)
+    parsed_args = vars(parser.parse_args())
+    config_path = parsed_args.pop("config")
 
     prerelease = None
     if parsed_args["prerelease"]:
@@ -368,25 +1303,19 @@ def main():
             return -1
         prerelease = False
     del parsed_args["no_prerelease"]
-    del parsed_args["prerelease"]
+    parsed_args["prerelease"] = prerelease
 
-    if parsed_args["repo"]:
-        repositories = {
-            parsed_args["repo"]: {}
-        }
-        del parsed_args["repo"]
-    else:
-        repositories = parsed_conf
-
-    for key, val in parsed_args.copy().items():
-        if val is None:
-            del parsed_args[key]
-
-    options.update(parsed_args)
+    try:
+        options, repositories = load_config(config_path, parsed_args)
+    except Exception as e:
+        logging.error(e)
+        return -1
 
+    # Progress is kept off the output of `--check` unless asked for
+    log_level = logging.WARNING if options["check"] else logging.INFO
     logging.basicConfig(
         format="%(levelname)-6s %(message)s",
-        level=logging.DEBUG if options["verbose"] else logging.INFO
+        level=logging.DEBUG if options["verbose"] else log_level
     )
     del options["verbose"]
 
@@ -395,28 +1324,101 @@ def main():
         parser.print_help()
         return -1
 
-    ret_code = 0
-    for repo_identifier, repo_options in repositories.items():
-        logging.info(_("Processing: {}".format(repo_identifier)))
-        repo_options_merged = options.copy()
-        repo_options_merged.update(repo_options)
+    jobs = options.pop("jobs")
+    if jobs < 1:
+        logging.error(_("`--jobs` must be at least 1."))
+        return -1
+    if options["hook_jobs"] < 1:
+        logging.error(_("`--hook-jobs` must be at least 1."))
+        return -1
+    engine = options.pop("engine")
+    if engine not in ENGINES:
+        logging.error(_("Unknown engine: {}").format(engine))
+        return -1
+    daemon = options.pop("daemon")
+    check = options.pop("check")
+    if check:
+        engine = "threads"
+    if daemon and engine == "asyncio":
+        logging.warning(_("`--daemon` always uses the threads engine."))
+        engine = "threads"
+    if engine == "asyncio":
         try:
-            splited_identifier = repo_identifier.split("/")
-            if len(splited_identifier) != 2:
-                raise Exception(
-                    _("Repo identifier must be in format of `repo/owner` "
-                      "(Erroneous input: {})").format(repo_identifier))
-            owner, repo = splited_identifier
-            download_repo_release(
-                owner=owner,
-                repo=repo,
-                logger=logging,
-                **repo_options_merged
-            )
-        except Exception as e:
-            logging.warning(_("Error occurred: {}").format(e))
-            logging.debug(traceback.format_exc())
-            ret_code = -1
+            from . import aio
+        except ImportError as e:
+            logging.error(
+                _("The asyncio engine requires aiohttp ({}).").format(e))
+            return -1
+
+    try:
+        bandwidth = BandwidthLimiter(parse_schedule(options.pop("max_rate")))
+    except Exception as e:
+        logging.error(_("Invalid `--max-rate`: {}").format(e))
+        return -1
+
+    run_options = {
+        "jobs": jobs,
+        "max_downloads": options.pop("max_downloads"),
+        "bandwidth": bandwidth,
+        "hook_jobs": options.pop("hook_jobs"),
+        "pool_size": options.pop("pool_size"),
+        "timeout": options.pop("timeout") or None,
+        "token": options.pop("token") or os.environ.get("GITHUB_TOKEN"),
+        "graphql": options.pop("graphql"),
+        "graphql_url": options.pop("graphql_url")
+    }
+    if run_options["graphql"] and not run_options["token"]:
+        logging.warning(
+            _("GraphQL lookups require a token, using the REST API."))
+        run_options["graphql"] = False
+    state_db = options.pop("state_db")
+    state = SqliteState(state_db) if state_db else None
+
+    if check:
+        from .check import check_repositories
+        try:
+            return check_repositories(
+                repositories, options, jobs, run_options["timeout"],
+                run_options["token"], run_options["graphql"],
+                run_options["graphql_url"], state)
+        finally:
+            if state:
+                state.close()
+
+    metrics_file = options.pop("metrics_file")
+    prometheus_file = options.pop("prometheus_file")
+    prometheus_port = options.pop("prometheus_port")
+    metrics = None
+    if metrics_file or prometheus_file or prometheus_port:
+        metrics = Metrics()
+    if prometheus_port and not daemon:
+        logging.warning(_("`--prometheus-port` is only used in daemon mode."))
+
+    from tqdm.contrib.logging import logging_redirect_tqdm
+    try:
+        with logging_redirect_tqdm():
+            if daemon:
+                from .daemon import Daemon
+                Daemon(config_path, parsed_args, state=state, metrics=metrics,
+                       prometheus_file=prometheus_file,
+                       prometheus_port=prometheus_port, **run_options)(
+                    repositories, options)
+                return 0
+            if engine == "asyncio":
+                import asyncio
+                ret_code = asyncio.run(aio.run_repositories(
+                    repositories, options, state=state, metrics=metrics,
+                    **run_options))
+            else:
+                ret_code = run_repositories(
+                    repositories, options, state=state, metrics=metrics,
+                    **run_options)
+            collect_garbage(repositories, options)
+    finally:
+        if state:
+            state.close()
+        if metrics:
+            write_metrics(metrics, metrics_file, prometheus_file)
 
     logging.info(_("Finished.") if ret_code == 0 else _("Partially finished."))
     return ret_code
@@ -0,0 +1,314 @@
+import copy
+import json
+import os
+import threading
+import time
+
+
+class Phase:
+
+    def __init__(self, repo_metrics, name):
+        self.repo_metrics = repo_metrics
+        self.name = name
+        # The check running when the phase was made, as background hooks
+        # may end after the next one started
+        self.check = repo_metrics.last
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.repo_metrics.add_phase(
+            self.name, time.monotonic() - self.started, self.check)
+
+
+# Stands in for RepoMetrics when metrics are disabled, so instrumented code
+# pays no more than a method call
+class NullRepoMetrics:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def track(self):
+        return self
+
+    def phase(self, name):
+        return self
+
+    def add_phase(self, name, seconds, check=None):
+        pass
+
+    def record_result(self, changed):
+        pass
+
+    def record_asset(self, filename, size, seconds):
+        pass
+
+    def record_retry(self):
+        pass
+
+    def record_rate_limit_wait(self, seconds):
+        pass
+
+    def record_cache_hit(self, cache):
+        pass
+
+
+NULL_REPO_METRICS = NullRepoMetrics()
+
+
+# Metrics of the latest check of a repository, along with counters that
+# keep growing over the checks of a daemon
+class RepoMetrics(NullRepoMetrics):
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.totals = {
+            "checks": 0,
+            "failures": 0,
+            "updates": 0,
+            "downloads": 0,
+            "bytes": 0,
+            "retries": 0,
+            "rate_limit_wait": 0.0,
+            "cache_hits": {}
+        }
+        self.last = None
+
+    def start_check(self):
+        self.last = {
+            "timestamp": time.time(),
+            "result": None,
+            "duration": None,
+            "phases": {},
+            "retries": 0,
+            "rate_limit_wait": 0.0,
+            "cache_hits": {},
+            "bytes": 0,
+            "assets": []
+        }
+        self.started = time.monotonic()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            self.last["duration"] = time.monotonic() - self.started
+            self.totals["checks"] += 1
+            if exc_type is not None:
+                self.last["result"] = "failed"
+                self.last["error"] = str(exc_value)
+                self.totals["failures"] += 1
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_phase(self, name, seconds, check=None):
+        with self.lock:
+            phases = (check if check is not None else self.last)["phases"]
+            phases[name] = phases.get(name, 0.0) + seconds
+
+    def record_result(self, changed):
+        with self.lock:
+            self.last["result"] = "updated" if changed else "unchanged"
+            if changed:
+                self.totals["updates"] += 1
+
+    def record_asset(self, filename, size, seconds):
+        with self.lock:
+            self.last["assets"].append({
+                "filename": filename,
+                "bytes": size,
+                "seconds": seconds,
+                "throughput": size / seconds if seconds else None
+            })
+            self.last["bytes"] += size
+            self.totals["bytes"] += size
+            self.totals["downloads"] += 1
+
+    def record_retry(self):
+        with self.lock:
+            self.last["retries"] += 1
+            self.totals["retries"] += 1
+
+    def record_rate_limit_wait(self, seconds):
+        with self.lock:
+            self.last["rate_limit_wait"] += seconds
+            self.totals["rate_limit_wait"] += seconds
+
+    def record_cache_hit(self, cache):
+        with self.lock:
+            for hits in (self.last["cache_hits"], self.totals["cache_hits"]):
+                hits[cache] = hits.get(cache, 0) + 1
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.repos = {}
+
+    def repo(self, repo_identifier):
+        with self.lock:
+            if repo_identifier not in self.repos:
+                self.repos[repo_identifier] = RepoMetrics(self.lock)
+            repo_metrics = self.repos[repo_identifier]
+            repo_metrics.start_check()
+        return repo_metrics
+
+    def summary(self):
+        with self.lock:
+            repositories = {}
+            for repo_identifier, repo_metrics in self.repos.items():
+                if repo_metrics.last is not None:
+                    repositories[repo_identifier] = copy.deepcopy(
+                        dict(repo_metrics.last, totals=repo_metrics.totals))
+            totals = {
+                "repositories": len(repositories),
+                "failed": 0,
+                "updated": 0,
+                "downloads": 0,
+                "bytes": 0,
+                "retries": 0,
+                "rate_limit_wait": 0.0,
+                "cache_hits": {}
+            }
+            for repo in repositories.values():
+                if repo["result"] == "failed":
+                    totals["failed"] += 1
+                elif repo["result"] == "updated":
+                    totals["updated"] += 1
+                totals["downloads"] += len(repo["assets"])
+                for key in ("bytes", "retries", "rate_limit_wait"):
+                    totals[key] += repo[key]
+                for cache, hits in repo["cache_hits"].items():
+                    totals["cache_hits"][cache] = \
+                        totals["cache_hits"].get(cache, 0) + hits
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "totals": totals,
+                "repositories": repositories
+            }
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        # For the textfile collector of the node exporter
+        write_atomic(path, self.prometheus())
+
+    def prometheus(self):
+        samples = {name: [] for name, _type, _help in PROMETHEUS_METRICS}
+        with self.lock:
+            for repo_identifier, repo_metrics in self.repos.items():
+                last, totals = repo_metrics.last, repo_metrics.totals
+                labels = {"repo": repo_identifier}
+                samples["hublatest_checks_total"].append(
+                    (labels, totals["checks"]))
+                samples["hublatest_check_failures_total"].append(
+                    (labels, totals["failures"]))
+                samples["hublatest_updates_total"].append(
+                    (labels, totals["updates"]))
+                samples["hublatest_downloads_total"].append(
+                    (labels, totals["downloads"]))
+                samples["hublatest_downloaded_bytes_total"].append(
+                    (labels, totals["bytes"]))
+                samples["hublatest_retries_total"].append(
+                    (labels, totals["retries"]))
+                samples["hublatest_rate_limit_wait_seconds_total"].append(
+                    (labels, totals["rate_limit_wait"]))
+                for cache, hits in totals["cache_hits"].items():
+                    samples["hublatest_cache_hits_total"].append(
+                        (dict(labels, cache=cache), hits))
+                if last is None or last["duration"] is None:
+                    continue
+                samples["hublatest_last_check_timestamp_seconds"].append(
+                    (labels, last["timestamp"]))
+                samples["hublatest_last_check_success"].append(
+                    (labels, int(last["result"] != "failed")))
+                samples["hublatest_last_check_duration_seconds"].append(
+                    (labels, last["duration"]))
+                for phase, seconds in last["phases"].items():
+                    samples["hublatest_last_check_phase_seconds"].append(
+                        (dict(labels, phase=phase), seconds))
+
+        lines = []
+        for name, metric_type, description in PROMETHEUS_METRICS:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in samples[name]:
+                lines.append("{}{{{}}} {}".format(name, ",".join(
+                    '{}="{}"'.format(key, escape_label(label_value))
+                    for key, label_value in labels.items()), value))
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+PROMETHEUS_METRICS = (
+    ("hublatest_checks_total", "counter",
+     "Release checks of the repository."),
+    ("hublatest_check_failures_total", "counter",
+     "Release checks of the repository that failed."),
+    ("hublatest_updates_total", "counter",
+     "Release checks of the repository that found changed files."),
+    ("hublatest_downloads_total", "counter",
+     "Files downloaded for the repository."),
+    ("hublatest_downloaded_bytes_total", "counter",
+     "Bytes downloaded for the repository."),
+    ("hublatest_retries_total", "counter",
+     "Failed requests of the repository that were retried."),
+    ("hublatest_rate_limit_wait_seconds_total", "counter",
+     "Time spent waiting for the API rate limit to reset."),
+    ("hublatest_cache_hits_total", "counter",
+     "Work saved by the HTTP cache, the hash index or GraphQL lookups."),
+    ("hublatest_last_check_timestamp_seconds", "gauge",
+     "Time of the latest release check of the repository."),
+    ("hublatest_last_check_success", "gauge",
+     "Whether the latest release check of the repository succeeded."),
+    ("hublatest_last_check_duration_seconds", "gauge",
+     "Duration of the latest release check of the repository."),
+    ("hublatest_last_check_phase_seconds", "gauge",
+     "Time spent in each phase of the latest release check."),
+)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def write_atomic(path, text):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+    os.replace(temp_path, path)
@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+
+# Once less than this share of the hourly quota is left, API requests are
+# spread evenly over the time remaining until the quota is reset
+PACE_THRESHOLD = 0.1
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Wait used for secondary rate limits, which come without a reset time
+SECONDARY_LIMIT_WAIT = 60.0
+
+
+class RateLimited(Exception):
+
+    def __init__(self, delay):
+        super().__init__("Rate limited for {:.0f} seconds".format(delay))
+        self.delay = delay
+
+
+# Shared by every repository of a run, so the quota reported by GitHub's
+# `X-RateLimit-*` headers is tracked across all API requests
+class RateLimiter:
+
+    def __init__(self, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.next_request = 0.0
+
+    def reserve(self):
+        # Returns how long to wait before sending the next API request
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request)
+            if self.reset is not None and self.reset <= now:
+                self.remaining = self.reset = None
+            if self.remaining is not None and self.reset is not None:
+                if self.remaining <= 0:
+                    start = max(start, self.reset)
+                elif self.remaining < self.limit * PACE_THRESHOLD:
+                    self.next_request = \
+                        start + (self.reset - start) / self.remaining
+                # Count the request right away, so concurrent callers do not
+                # all spend the last few requests at once
+                self.remaining -= 1
+            return start - now
+
+    def update(self, status_code, headers):
+        # Returns the delay to wait before retrying if the response tells
+        # that the rate limit was hit, otherwise None
+        with self.lock:
+            if headers.get("X-RateLimit-Remaining") is not None:
+                try:
+                    self.limit = int(headers["X-RateLimit-Limit"])
+                    self.remaining = int(headers["X-RateLimit-Remaining"])
+                    self.reset = float(headers["X-RateLimit-Reset"])
+                except (KeyError, ValueError):
+                    pass
+            if status_code not in (403, 429):
+                return None
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            if retry_after is not None:
+                self.next_request = max(self.next_request,
+                                        time.time() + retry_after)
+                return retry_after
+            if self.remaining == 0 and self.reset is not None:
+                return max(0.0, self.reset - time.time()) + 1
+            if status_code == 429:
+                return SECONDARY_LIMIT_WAIT
+            return None
+
+    def backoff(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,20 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+# One pooled session is shared by every API request and download of a run,
+# so connections are kept alive across repositories, retries and ranges
+class Session(requests.Session):
+
+    def __init__(self, pool_size=10, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
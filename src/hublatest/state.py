@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+
+
+VER_FILE_NAME_TEMPLATE_SUBDIR = "{0}/{1}.json"
+VER_FILE_NAME_TEMPLATE_NO_SUBDIR = ".{0}.{1}.json"
+HTTP_CACHE_FILE_NAME_TEMPLATE_SUBDIR = "{0}/{1}.http_cache.json"
+HTTP_CACHE_FILE_NAME_TEMPLATE_NO_SUBDIR = ".{0}.{1}.http_cache.json"
+
+# Keys of a repository's state record kept in the version file
+VERSION_KEYS = ("version", "files", "hash_index")
+
+# Pending SQLite updates are committed after this many repositories or
+# this many seconds, whichever comes first
+SQLITE_BATCH_SIZE = 50
+SQLITE_BATCH_INTERVAL = 1.0
+
+
+def write_json_atomic(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+# A repository's state is a dict record with the keys `version`, `files`
+# (list of AssetFile dicts), `hash_index` and `http_cache`; `save` takes
+# only the keys to be updated.
+class JsonState:
+
+    def __init__(self, version_file_dir, use_subdir=False):
+        self.version_file_dir = version_file_dir
+        self.use_subdir = use_subdir
+
+    def get_paths(self, owner, repo):
+        if self.use_subdir:
+            ver_file_name_template = VER_FILE_NAME_TEMPLATE_SUBDIR
+            http_cache_file_name_template = HTTP_CACHE_FILE_NAME_TEMPLATE_SUBDIR
+        else:
+            ver_file_name_template = VER_FILE_NAME_TEMPLATE_NO_SUBDIR
+            http_cache_file_name_template = \
+                HTTP_CACHE_FILE_NAME_TEMPLATE_NO_SUBDIR
+        return (
+            os.path.join(self.version_file_dir,
+                         ver_file_name_template.format(owner, repo)),
+            os.path.join(self.version_file_dir,
+                         http_cache_file_name_template.format(owner, repo)))
+
+    def load(self, owner, repo, legacy=None):
+        version_file_path, http_cache_path = self.get_paths(owner, repo)
+        record = {}
+        if os.path.isfile(version_file_path):
+            with open(version_file_path) as ver_file:
+                record.update(json.load(ver_file))
+            # The HTTP cache is only trusted while the version file exists
+            if os.path.isfile(http_cache_path):
+                try:
+                    with open(http_cache_path) as cache_file:
+                        record["http_cache"] = json.load(cache_file)
+                except ValueError:
+                    pass
+        return record
+
+    def save(self, owner, repo, updates):
+        version_file_path, http_cache_path = self.get_paths(owner, repo)
+        if any(key in updates for key in VERSION_KEYS):
+            os.makedirs(os.path.dirname(version_file_path), 0o755, True)
+            write_json_atomic(version_file_path, {
+                key: updates[key] for key in VERSION_KEYS})
+        if updates.get("http_cache"):
+            os.makedirs(os.path.dirname(http_cache_path), 0o755, True)
+            write_json_atomic(http_cache_path, updates["http_cache"])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteState:
+
+    COLUMNS = ("version", "files", "hash_index", "http_cache", "last_check")
+    JSON_COLUMNS = ("files", "hash_index", "http_cache")
+
+    def __init__(self, path):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS repos ("
+            "owner TEXT NOT NULL, repo TEXT NOT NULL, version TEXT, "
+            "files TEXT, hash_index TEXT, http_cache TEXT, last_check REAL, "
+            "PRIMARY KEY (owner, repo))")
+        self.connection.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+        # Everything is read once up front; later reads are served from memory
+        self.records = {}
+        rows = self.connection.execute(
+            "SELECT owner, repo, {} FROM repos".format(
+                ", ".join(self.COLUMNS)))
+        for row in rows:
+            record = {}
+            for key, value in zip(self.COLUMNS, row[2:]):
+                if value is not None and key in self.JSON_COLUMNS:
+                    value = json.loads(value)
+                if value is not None:
+                    record[key] = value
+            self.records[row[0], row[1]] = record
+
+    def load(self, owner, repo, legacy=None):
+        with self.lock:
+            record = self.records.get((owner, repo))
+        if record is None and legacy is not None:
+            # One-time migration from the repository's JSON state files
+            record = legacy.load(owner, repo)
+            if record:
+                self.save(owner, repo, record)
+        return dict(record or {})
+
+    def save(self, owner, repo, updates):
+        with self.lock:
+            record = self.records.setdefault((owner, repo), {})
+            record.update(updates)
+            record["last_check"] = time.time()
+            values = []
+            for key in self.COLUMNS:
+                value = record.get(key)
+                if value is not None and key in self.JSON_COLUMNS:
+                    value = json.dumps(value)
+                values.append(value)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO repos (owner, repo, {}) "
+                "VALUES (?, ?, {})".format(
+                    ", ".join(self.COLUMNS),
+                    ", ".join("?" * len(self.COLUMNS))),
+                [owner, repo] + values)
+            self.pending += 1
+            if self.pending >= SQLITE_BATCH_SIZE or \
+                    time.monotonic() - self.last_commit >= \
+                    SQLITE_BATCH_INTERVAL:
+                self.commit_locked()
+
+    def commit_locked(self):
+        self.connection.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.commit_locked()
+
+    def close(self):
+        with self.lock:
+            self.commit_locked()
+            self.connection.close()
@@ -0,0 +1,24 @@
+import io
+import random
+
+
+def random_bytes(seed, size):
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, "little")
+
+
+# Stands in for a response of requests, with the body readable from `raw`
+# and the parsed JSON given as `data`
+class FakeResponse:
+
+    def __init__(self, status_code=200, body=b"", headers=None, data=None):
+        self.status_code = status_code
+        self.raw = io.BytesIO(body)
+        self.headers = {"content-length": str(len(body))}
+        self.headers.update(headers or {})
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def close(self):
+        pass
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+# The asyncio engine is an optional extra
+pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from hublatest import aio  # noqa: E402
+
+
+ASSETS = {"a.bin": b"a" * 100, "b.bin": b"b" * 200, "c.bin": b"c" * 300}
+
+
+async def serve_asset(request):
+    return web.Response(body=ASSETS[request.match_info["name"]])
+
+
+async def download_release(tag, names, **kwargs):
+    app = web.Application()
+    app.router.add_get("/download/{name}", serve_asset)
+    async with TestServer(app) as server:
+        release = {"tag_name": tag, "assets": [
+            {"name": name, "size": len(ASSETS[name]),
+             "updated_at": "2020-01-01T00:00:00Z",
+             "browser_download_url": str(server.make_url("/download/" + name))}
+            for name in names]}
+        return await aio.download_repo_release(
+            "owner", "repo", release=release, **kwargs)
+
+
+def list_files(directory):
+    return sorted(path.name for path in directory.iterdir())
+
+
+def test_download_repo_release_waits_for_hooks(tmp_path):
+    assert asyncio.run(download_release(
+        "v1", ASSETS, download_dir=str(tmp_path),
+        post_download="sleep 0.2; touch {filepath}.done"))
+    assert list_files(tmp_path) == [
+        "a.bin", "a.bin.done", "b.bin", "b.bin.done", "c.bin", "c.bin.done"]
+
+
+def test_download_repo_release_removes_old_files(tmp_path):
+    download_dir = tmp_path / "download"
+    options = dict(version_file_dir=str(tmp_path),
+                   download_dir=str(download_dir),
+                   post_remove="touch {filepath}.removed")
+    assert asyncio.run(download_release("v1", ["a.bin", "b.bin"], **options))
+    assert asyncio.run(download_release("v2", ["b.bin", "c.bin"], **options))
+    assert list_files(download_dir) == ["a.bin.removed", "b.bin", "c.bin"]
+    assert (download_dir / "c.bin").read_bytes() == ASSETS["c.bin"]
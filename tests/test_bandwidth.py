@@ -0,0 +1,48 @@
+import pytest
+
+from hublatest.bandwidth import parse_rate, parse_schedule
+
+
+@pytest.mark.parametrize("value, rate", [
+    ("0", 0),
+    ("off", 0),
+    ("500", 500),
+    ("200K", 200 * 1024),
+    ("1.5M", int(1.5 * 1024 ** 2)),
+    ("2g", 2 * 1024 ** 3),
+    ("10MB/s", 10 * 1024 ** 2),
+    ("64KiB", 64 * 1024),
+])
+def test_parse_rate(value, rate):
+    assert parse_rate(value) == rate
+
+
+@pytest.mark.parametrize("value", ["", "fast", "-1M", "5T", "1M/h"])
+def test_parse_rate_invalid(value):
+    with pytest.raises(Exception, match="Invalid rate"):
+        parse_rate(value)
+
+
+def test_parse_schedule_single_rate():
+    assert parse_schedule("5M") == [(0, 5 * 1024 ** 2)]
+    for value in (None, "", "  ", "0", "off"):
+        assert parse_schedule(value) == []
+
+
+def test_parse_schedule_entries():
+    assert parse_schedule("19:00,50M 23:30,off 08:00,5M") == [
+        (8 * 60, 5 * 1024 ** 2), (19 * 60, 50 * 1024 ** 2), (23 * 60 + 30, 0)]
+    assert parse_schedule("08:00,off 19:00,0") == []
+
+
+@pytest.mark.parametrize("value, message", [
+    ("08:00", "Invalid rate"),
+    ("08:00,5M 19:00", "Invalid schedule entry: 19:00"),
+    ("8,5M 19:00,off", "Invalid schedule entry: 8,5M"),
+    ("24:00,5M 19:00,off", "Invalid schedule entry: 24:00,5M"),
+    ("08:60,5M 19:00,off", "Invalid schedule entry: 08:60,5M"),
+    ("08:00,fast 19:00,off", "Invalid rate: fast"),
+])
+def test_parse_schedule_invalid(value, message):
+    with pytest.raises(Exception, match=message):
+        parse_schedule(value)
@@ -0,0 +1,36 @@
+from hublatest.hublatest import get_arg_parser, get_repo_arguments, load_config
+
+
+CONFIG = """[DEFAULT]
+max_rate = 1M
+
+[owner/shared]
+
+[owner/limited]
+max_rate = 200K
+"""
+
+
+def test_max_rate_of_default_section_is_global(tmp_path):
+    config_path = tmp_path / "config.ini"
+    config_path.write_text(CONFIG)
+    for cli_rate, global_rate in ((None, "1M"), ("5M", "5M")):
+        options, repositories = load_config(
+            str(config_path), {"repo": None, "max_rate": cli_rate})
+        assert options["max_rate"] == global_rate
+        rates = {
+            repo_identifier: get_repo_arguments(
+                repo_identifier, options, repo_options)["max_rate"]
+            for repo_identifier, repo_options in repositories.items()}
+        assert rates == {"owner/shared": None, "owner/limited": "200K"}
+
+
+def test_verify_of_default_section(tmp_path):
+    config_path = tmp_path / "config.ini"
+    config_path.write_text("[DEFAULT]\nverify = true\n\n[owner/repo]\n")
+    parsed_args = vars(get_arg_parser().parse_args(
+        ["-c", str(config_path)]))
+    options, repositories = load_config(str(config_path), parsed_args)
+    assert options["verify"] is True
+    assert get_repo_arguments(
+        "owner/repo", options, repositories["owner/repo"])["verify"] is True
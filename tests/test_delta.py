@@ -0,0 +1,175 @@
+import hashlib
+
+import pytest
+
+from conftest import FakeResponse, random_bytes
+from hublatest import delta
+from hublatest.delta import (
+    DeltaDownload, ZsyncFile, get_rsum, md4, md4_fallback,
+    parse_content_range)
+
+
+BLOCK_SIZE = 2048
+
+
+def make_zsync(data, block_size=BLOCK_SIZE, hash_lengths=(2, 2, 5),
+               extra_headers=()):
+    seq_matches, rsum_bytes, checksum_bytes = hash_lengths
+    header = [
+        "zsync: 0.6.2",
+        "Filename: test.bin",
+        "Blocksize: {}".format(block_size),
+        "Length: {}".format(len(data)),
+        "Hash-Lengths: {},{},{}".format(*hash_lengths),
+        "SHA-1: " + hashlib.sha1(data).hexdigest()] + list(extra_headers)
+    checksums = bytearray()
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size].ljust(block_size, b"\0")
+        a, b = get_rsum(block)
+        checksums += ((a << 16) | b).to_bytes(4, "big")[4 - rsum_bytes:]
+        checksums += md4(block)[:checksum_bytes]
+    return ("\n".join(header) + "\n\n").encode() + bytes(checksums)
+
+
+def read_parts(response):
+    return [(start, end, reader.read(end + 1 - start))
+            for start, end, reader in DeltaDownload().iter_parts(response)]
+
+
+def test_zsync_file():
+    data = random_bytes(1, 5 * BLOCK_SIZE + 100)
+    zsync = ZsyncFile(make_zsync(data))
+    assert zsync.block_size == BLOCK_SIZE
+    assert zsync.length == len(data)
+    assert zsync.sha1 == hashlib.sha1(data).hexdigest()
+    assert (zsync.seq_matches, zsync.rsum_bytes, zsync.checksum_bytes) == \
+        (2, 2, 5)
+    assert zsync.blocks == 6
+    assert zsync.get_block_length(0) == BLOCK_SIZE
+    assert zsync.get_block_length(5) == 100
+    last_block = data[5 * BLOCK_SIZE:].ljust(BLOCK_SIZE, b"\0")
+    assert zsync.strong[5] == md4(last_block)[:5]
+    assert 5 in zsync.index[zsync.rsums[5]]
+
+
+def test_zsync_file_default_hash_lengths():
+    data = random_bytes(2, 3 * BLOCK_SIZE)
+    zsync_data = make_zsync(data, hash_lengths=(1, 4, 16)).replace(
+        b"Hash-Lengths: 1,4,16\n", b"")
+    zsync = ZsyncFile(zsync_data)
+    assert (zsync.seq_matches, zsync.rsum_bytes, zsync.checksum_bytes) == \
+        (1, 4, 16)
+    a, b = get_rsum(data[:BLOCK_SIZE])
+    assert zsync.rsums[0] == (a << 16) | b
+
+
+@pytest.mark.parametrize("zsync_data, message", [
+    (b"zsync: 0.6.2\nBlocksize: 2048\n", "Malformed zsync file"),
+    (b"Blocksize: 2048\nLength: 4096\nZ-Map2: 1\n\n",
+     "Compressed zsync files are not supported"),
+    (b"Blocksize: 2048\nLength: 4096\nHash-Lengths: 2,2,5\n\n1234567",
+     "Truncated zsync file"),
+])
+def test_zsync_file_errors(zsync_data, message):
+    with pytest.raises(Exception, match=message):
+        ZsyncFile(zsync_data)
+
+
+def test_iter_parts_single_range():
+    response = FakeResponse(206, b"0123456789", {
+        "content-type": "application/octet-stream",
+        "content-range": "bytes 100-109/1000"})
+    assert read_parts(response) == [(100, 109, b"0123456789")]
+
+
+def test_iter_parts_multipart():
+    body = (
+        b"\r\n--THIS_STRING_SEPARATES\r\n"
+        b"Content-Type: application/octet-stream\r\n"
+        b"Content-Range: bytes 0-4/1000\r\n"
+        b"\r\n"
+        b"ab\r\nc\r\n"
+        b"--THIS_STRING_SEPARATES\r\n"
+        b"Content-Range: bytes 500-502/1000\r\n"
+        b"\r\n"
+        b"xyz\r\n"
+        b"--THIS_STRING_SEPARATES--\r\n")
+    response = FakeResponse(206, body, {
+        "content-type":
+            'multipart/byteranges; boundary="THIS_STRING_SEPARATES"'})
+    assert read_parts(response) == [(0, 4, b"ab\r\nc"), (500, 502, b"xyz")]
+
+
+def test_iter_parts_errors():
+    response = FakeResponse(206, b"", {"content-type": "multipart/byteranges"})
+    with pytest.raises(Exception, match="Missing multipart boundary"):
+        read_parts(response)
+    response = FakeResponse(206, b"--other\r\n\r\n", {
+        "content-type": "multipart/byteranges; boundary=sep"})
+    with pytest.raises(Exception, match="Malformed multipart response"):
+        read_parts(response)
+
+
+def test_parse_content_range():
+    assert parse_content_range("bytes 0-99/100") == (0, 99)
+    assert parse_content_range("bytes 10-19/*") == (10, 19)
+    with pytest.raises(Exception, match="Unexpected Content-Range"):
+        parse_content_range("bytes */100")
+
+
+def test_get_rsum():
+    block = random_bytes(3, 64)
+    a = sum(block) & 0xffff
+    b = sum((len(block) - i) * byte for i, byte in enumerate(block)) & 0xffff
+    assert get_rsum(block) == (a, b)
+
+
+# The test suite of RFC 1320
+@pytest.mark.parametrize("message, digest", [
+    (b"", "31d6cfe0d16ae931b73c59d7e0c089c0"),
+    (b"a", "bde52cb31de33e46245e05fbdbd6fb24"),
+    (b"abc", "a448017aaf21d8525fc10ae87aa6729d"),
+    (b"message digest", "d9130a8164549fe818874806e1c7014b"),
+    (b"abcdefghijklmnopqrstuvwxyz", "d79e1c308aa5bbcdeea8ed63df412da9"),
+    (b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789",
+     "043f8582f241db351ce627e153e7f0e4"),
+    (b"1234567890" * 8, "e33b4ddc9c38f2199c3e7b164fcc0536"),
+])
+def test_md4(message, digest):
+    assert md4_fallback(message).hex() == digest
+    assert md4(message).hex() == digest
+
+
+def test_md4_padding_boundaries():
+    for size in (55, 56, 63, 64, 65, 119, 120):
+        message = random_bytes(size, size)
+        assert md4_fallback(message) == md4(message)
+        assert md4_fallback(bytearray(message)) == md4(message)
+
+
+def test_find_blocks():
+    seed = random_bytes(4, 32 * BLOCK_SIZE)
+    # A block replaced and a few bytes inserted, which shifts the rest
+    new = bytearray(seed)
+    new[3 * BLOCK_SIZE:4 * BLOCK_SIZE] = random_bytes(5, BLOCK_SIZE)
+    new[10 * BLOCK_SIZE:10 * BLOCK_SIZE] = b"inserted"
+    new = bytes(new)
+    download = DeltaDownload()
+    download.zsync = ZsyncFile(make_zsync(new))
+    found = download.find_blocks(seed)
+    # A block only matches when followed by the next one, so the blocks
+    # before the changes and the padded last one are missing as well
+    assert set(range(download.zsync.blocks)) - set(found) == \
+        {2, 3, 9, 10, 31, 32}
+    for i, offset in found.items():
+        block_length = download.zsync.get_block_length(i)
+        assert seed[offset:offset + block_length] == \
+            new[i * BLOCK_SIZE:i * BLOCK_SIZE + block_length]
+    assert download.get_missing_ranges(found)[0][0] == 2 * BLOCK_SIZE
+
+
+def test_find_blocks_unrelated(monkeypatch):
+    monkeypatch.setattr(delta, "PROBE_SIZE", 16 * BLOCK_SIZE)
+    download = DeltaDownload()
+    download.zsync = ZsyncFile(make_zsync(random_bytes(6, 64 * BLOCK_SIZE)))
+    assert download.find_blocks(random_bytes(7, 64 * BLOCK_SIZE)) is None
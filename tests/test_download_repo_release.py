@@ -0,0 +1,80 @@
+import json
+import logging
+
+import pytest
+
+from conftest import FakeResponse
+from hublatest.hublatest import AssetFile, DownloadRepoRelease
+
+
+BASE_URL = "https://github.com/owner/repo/releases/download/"
+
+
+def make_part(directory, filename, url):
+    (directory / (filename + ".part")).write_bytes(b"partial")
+    (directory / (filename + ".part.json")).write_text(json.dumps(
+        {"url": url, "length": 100, "updated_at": "2020-01-01T00:00:00Z"}))
+
+
+def test_remove_stale_parts(tmp_path):
+    make_part(tmp_path, "app-v2.zip", BASE_URL + "v2/app-v2.zip")
+    make_part(tmp_path, "app-v3.zip", BASE_URL + "v3/app-v3.zip")
+    make_part(tmp_path, "other.zip",
+              "https://github.com/owner/other/releases/download/v1/other.zip")
+    (tmp_path / "broken.zip.part.json").write_text("{")
+    download = DownloadRepoRelease()
+    download.download_dir = str(tmp_path)
+    download.logger = logging.getLogger("test")
+    download.release_files = {
+        BASE_URL + "v3/app-v3.zip": AssetFile("app-v3.zip", "", 100)}
+    download.remove_stale_parts()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "app-v3.zip.part", "app-v3.zip.part.json", "broken.zip.part.json",
+        "other.zip.part", "other.zip.part.json"]
+
+
+def run_lookup(download, respond):
+    requests = []
+    lookup = download.lookup_release()
+    try:
+        request = next(lookup)
+        while True:
+            requests.append(request)
+            request = lookup.send(respond(*request))
+    except StopIteration as e:
+        return e.value, requests
+
+
+def make_lookup(prerelease):
+    download = DownloadRepoRelease()
+    download.api_url = "https://api.github.com"
+    download.owner, download.repo = "owner", "repo"
+    download.prerelease = prerelease
+    download.regex_filter = None
+    download.logger = logging.getLogger("test")
+    return download
+
+
+def test_lookup_prerelease_pages_are_capped():
+    stable = [{"tag_name": "v{}".format(i), "prerelease": False}
+              for i in range(100, 0, -1)]
+    requests = []
+
+    def respond(url, first):
+        requests.append(url.rsplit("/", 1)[1])
+        page = int(url.rsplit("page=", 1)[1])
+        return FakeResponse(data=stable[(page - 1) * 10:page * 10])
+
+    with pytest.raises(Exception, match="No suitable releases found"):
+        run_lookup(make_lookup(True), respond)
+    assert requests == [
+        "releases?per_page=10&page=1", "releases?per_page=10&page=2"]
+
+
+def test_lookup_finds_prerelease():
+    releases = [{"tag_name": "v2", "prerelease": False},
+                {"tag_name": "v2-rc", "prerelease": True}]
+    release, requests = run_lookup(
+        make_lookup(True), lambda url, first: FakeResponse(data=releases))
+    assert release["tag_name"] == "v2-rc"
+    assert len(requests) == 1
@@ -0,0 +1,108 @@
+import hashlib
+import re
+
+import pytest
+
+from conftest import FakeResponse, random_bytes
+from hublatest.file_download import MIN_SEGMENT_SIZE, FileDownload
+
+
+URL = "https://github.com/owner/repo/releases/download/v1/app.zip"
+
+
+class FakeSession:
+
+    def __init__(self, data, ranges=True, content_range=True):
+        self.data = data
+        self.ranges = ranges
+        self.content_range = content_range
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False):
+        range_header = (headers or {}).get("Range")
+        self.requests.append(range_header)
+        if not self.ranges or range_header is None:
+            return FakeResponse(200, self.data)
+        start, end = re.match(r"bytes=(\d+)-(\d*)$", range_header).groups()
+        start = int(start)
+        end = int(end) if end else len(self.data) - 1
+        headers = {}
+        if self.content_range:
+            headers["content-range"] = "bytes {}-{}/{}".format(
+                start, end, len(self.data))
+        return FakeResponse(206, self.data[start:end + 1], headers)
+
+
+def prepare(tmp_path, length=None):
+    download = FileDownload()
+    download.prepare(URL, str(tmp_path / "app.zip"), length)
+    open(download.part_path, "ab").close()
+    return download
+
+
+def test_check_response_full_content(tmp_path):
+    download = prepare(tmp_path)
+    with open(download.part_path, "r+b") as f:
+        assert download.check_response(f, 200, 100, 0, None) == (0, 100)
+        with pytest.raises(Exception, match="Size changed"):
+            download.check_response(f, 200, 90, 0, 100)
+
+
+def test_check_response_range_ignored(tmp_path):
+    download = prepare(tmp_path, 100)
+    with open(download.part_path, "r+b") as f:
+        f.write(b"x" * 40)
+        download.sha256 = hashlib.sha256(b"x" * 40)
+        assert download.check_response(f, 200, 100, 40, 100) == (0, 100)
+        assert f.tell() == 0
+        assert download.meta["downloaded"] == 0
+        assert download.sha256.hexdigest() == hashlib.sha256().hexdigest()
+
+
+def test_check_response_partial_content(tmp_path):
+    download = prepare(tmp_path, 100)
+    with open(download.part_path, "r+b") as f:
+        assert download.check_response(f, 206, 60, 40, 100) == (40, 100)
+        with pytest.raises(Exception, match="Size changed"):
+            download.check_response(f, 206, 70, 40, 100)
+        # Nothing was asked for a range
+        with pytest.raises(Exception, match="Server returned 206"):
+            download.check_response(f, 206, 100, 0, None)
+        with pytest.raises(Exception, match="Server returned 416"):
+            download.check_response(f, 416, 0, 40, 100)
+
+
+def test_download_resumes_with_range(tmp_path):
+    data = random_bytes(1, 1000)
+    file_path = tmp_path / "app.zip"
+    (tmp_path / "app.zip.part").write_bytes(data[:400])
+    prepare(tmp_path, len(data))
+    session = FakeSession(data)
+    download = FileDownload()
+    assert download(URL, str(file_path), session=session,
+                    length=len(data)) == hashlib.sha256(data).hexdigest()
+    assert session.requests == ["bytes=400-"]
+    assert download.received == 600
+    assert file_path.read_bytes() == data
+
+
+@pytest.mark.parametrize("session_options", [
+    {}, {"ranges": False}, {"content_range": False}])
+def test_download_segmented(tmp_path, session_options):
+    data = random_bytes(2, 3 * MIN_SEGMENT_SIZE)
+    file_path = tmp_path / "app.zip"
+    session = FakeSession(data, **session_options)
+    download = FileDownload()
+    assert download(URL, str(file_path), segments=3, session=session,
+                    length=len(data)) == hashlib.sha256(data).hexdigest()
+    assert file_path.read_bytes() == data
+    assert download.received == len(data)
+    if not session_options:
+        assert sorted(session.requests) == [
+            "bytes=0-",
+            "bytes={}-{}".format(MIN_SEGMENT_SIZE, 2 * MIN_SEGMENT_SIZE - 1),
+            "bytes={}-{}".format(2 * MIN_SEGMENT_SIZE, len(data) - 1)]
+    else:
+        # Without a usable Content-Range, it falls back to a single stream
+        assert session.requests[0] == "bytes=0-"
+        assert len(session.requests) == 2
@@ -0,0 +1,17 @@
+from hublatest.metrics import Metrics
+
+
+def test_phase_counts_towards_its_own_check():
+    metrics = Metrics()
+    repo_metrics = metrics.repo("owner/repo")
+    first_check = repo_metrics.last
+    # A background hook made during the first check ends during the second
+    phase = repo_metrics.phase("hooks")
+    metrics.repo("owner/repo")
+    with phase:
+        pass
+    assert "hooks" in first_check["phases"]
+    assert "hooks" not in repo_metrics.last["phases"]
+    with repo_metrics.phase("api"):
+        pass
+    assert "api" in repo_metrics.last["phases"]
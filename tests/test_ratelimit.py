@@ -0,0 +1,97 @@
+import time
+
+from email.utils import formatdate
+
+import pytest
+
+from hublatest.ratelimit import (
+    SECONDARY_LIMIT_WAIT, RateLimiter, parse_retry_after)
+
+
+def rate_limit_headers(limit, remaining, reset):
+    return {
+        "X-RateLimit-Limit": str(limit),
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Reset": str(reset)}
+
+
+def test_update_tracks_quota():
+    limiter = RateLimiter()
+    reset = int(time.time()) + 3600
+    assert limiter.update(200, rate_limit_headers(5000, 4999, reset)) is None
+    assert (limiter.limit, limiter.remaining, limiter.reset) == \
+        (5000, 4999, reset)
+    # Malformed headers leave the quota as it was
+    headers = rate_limit_headers(5000, "many", reset)
+    assert limiter.update(200, headers) is None
+    assert limiter.remaining == 4999
+
+
+def test_reserve_without_quota():
+    limiter = RateLimiter()
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+
+
+def test_reserve_counts_requests():
+    limiter = RateLimiter()
+    limiter.update(200, rate_limit_headers(5000, 1000, time.time() + 3600))
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.remaining == 998
+
+
+def test_reserve_paces_requests_near_the_limit():
+    limiter = RateLimiter()
+    limiter.update(200, rate_limit_headers(5000, 100, time.time() + 100))
+    assert limiter.reserve() == 0
+    # The time left is spread over the requests left
+    assert limiter.reserve() == pytest.approx(1, abs=0.1)
+
+
+def test_reserve_waits_for_reset():
+    limiter = RateLimiter()
+    limiter.update(200, rate_limit_headers(60, 0, time.time() + 30))
+    assert limiter.reserve() == pytest.approx(30, abs=1)
+    # Once reset, the quota is unknown again
+    limiter.reset = time.time() - 1
+    assert limiter.reserve() == 0
+    assert limiter.remaining is None
+
+
+def test_update_exhausted_quota():
+    limiter = RateLimiter()
+    headers = rate_limit_headers(60, 0, time.time() + 30)
+    assert limiter.update(403, headers) == pytest.approx(31, abs=1)
+
+
+def test_update_retry_after():
+    limiter = RateLimiter()
+    assert limiter.update(429, {"Retry-After": "5"}) == 5
+    assert limiter.reserve() == pytest.approx(5, abs=0.1)
+    assert limiter.update(403, {"Retry-After": "2"}) == 2
+    # Retry-After is only honoured on rate limit responses
+    assert limiter.update(503, {"Retry-After": "2"}) is None
+
+
+def test_update_secondary_limit():
+    limiter = RateLimiter()
+    assert limiter.update(429, {}) == SECONDARY_LIMIT_WAIT
+    # A 403 without any rate limit information is a plain error
+    assert limiter.update(403, {}) is None
+
+
+def test_backoff():
+    limiter = RateLimiter(backoff_base=1, backoff_max=10)
+    for attempt in range(8):
+        assert 0 <= limiter.backoff(attempt) <= min(10, 2 ** attempt)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("-5") == 0
+    assert parse_retry_after("soon") is None
+    date = formatdate(time.time() + 60, usegmt=True)
+    assert parse_retry_after(date) == pytest.approx(60, abs=2)
+    assert parse_retry_after(formatdate(time.time() - 60, usegmt=True)) == 0